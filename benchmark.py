@@ -0,0 +1,379 @@
+import argparse
+import importlib.util
+import json
+import os
+import platform
+import random
+import sqlite3
+import statistics
+import sys
+import time
+from datetime import datetime, timedelta
+
+import config
+import database
+
+DEFAULT_SIZES = [1000, 10000, 100000, 1000000]
+PLACEHOLDER_IMAGES = 64
+THUMBNAIL_WIDTH = 400
+TAGS = ["backpack", "umbrella", "handbag", "suitcase", "bottle", "cup", "cell phone", "laptop", "book",
+        "keyboard", "mouse", "remote", "scissors", "clock", "teddy bear", "tie", "sports ball", "wine glass"]
+PLACES = [("University", "Dome building", "Ground floor"), ("University", "AB1 building", "1st floor"),
+          ("University", "AB2 building", "2nd floor"), ("University", "AB3 building", "3rd floor"),
+          ("University", "Grand stairs", "First floor"), ("Hostel", "B1", "Not applicable"),
+          ("Hostel", "B4", "Not applicable"), ("Hostel", "G2", "Not applicable"),
+          ("Hostel", "Bluedove mess", "Ground floor"), ("Hostel", "Quess mess", "First floor")]
+SPOTS = ["near the entrance", "library desk", "lecture hall", "canteen table", "corridor bench", "washroom"]
+SEARCH_TERMS = ["bottle", "lap", "dome", "cell phone", "library desk"]
+# Length of the pooled backbone features of the medium model
+EMBEDDING_DIMENSIONS = 576
+# A million float32 embeddings would need over 2 GB, larger sizes are left out of the similarity benchmark
+SIMILARITY_MAX_SIZE = 100000
+
+
+def placeholder_image(path, seed):
+    from PIL import Image, ImageDraw
+
+    rng = random.Random(seed)
+    image = Image.new("RGB", (640, 480), tuple(rng.randrange(256) for _ in range(3)))
+    draw = ImageDraw.Draw(image)
+    for _ in range(6):
+        x, y = rng.randrange(560), rng.randrange(400)
+        draw.rectangle((x, y, x + rng.randrange(40, 200), y + rng.randrange(40, 160)),
+                       fill=tuple(rng.randrange(256) for _ in range(3)))
+    image.save(path, "JPEG", quality=85)
+    return path
+
+
+def placeholder_images(data_dir):
+    # A small pool of images shared by every synthetic row, rows only differ in their metadata
+    image_dir = os.path.join(data_dir, "images")
+    os.makedirs(image_dir, exist_ok=True)
+    paths = []
+    for index in range(PLACEHOLDER_IMAGES):
+        path = os.path.join(image_dir, f"placeholder-{index}.jpg")
+        if not os.path.exists(path):
+            placeholder_image(path, index)
+        paths.append(path)
+    return paths
+
+
+def synthetic_rows(count, images, seed=0):
+    rng = random.Random(seed)
+    start = datetime(2024, 1, 1)
+    for index in range(count):
+        tags = rng.sample(TAGS, rng.randint(1, 2))
+        area, building, floor = rng.choice(PLACES)
+        specific_location = rng.choice(SPOTS)
+        reported = start + timedelta(seconds=rng.randrange(365 * 24 * 3600))
+        yield (index + 1, rng.choice(("Lost", "Found")), images[index % len(images)], tags,
+               database.format_location(area, building, floor, specific_location),
+               area, building, floor, specific_location, reported.strftime("%Y-%m-%d %H:%M:%S"),
+               rng.randrange(-(1 << 63), 1 << 63))
+
+
+def create_dataset(path, count, images):
+    # Built under a temporary name so an interrupted run is never mistaken for a finished dataset
+    temp_path = f"{path}.tmp"
+    if os.path.exists(temp_path):
+        os.remove(temp_path)
+    conn = database.open_connection(temp_path)
+    try:
+        database.migrate(conn)
+        cursor = conn.cursor()
+        items = []
+        tags = []
+        for row in synthetic_rows(count, images):
+            item_id, item_type, image_path, item_tags = row[:4]
+            items.append((item_id, item_type, image_path, ",".join(item_tags)) + row[4:])
+            tags += [(item_id, tag, 0.9) for tag in item_tags]
+            if len(items) >= 10000:
+                insert_rows(cursor, items, tags)
+                items, tags = [], []
+        insert_rows(cursor, items, tags)
+        conn.commit()
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    finally:
+        conn.close()
+    os.replace(temp_path, path)
+
+
+def insert_rows(cursor, items, tags):
+    cursor.executemany("""
+        INSERT INTO items (id, item_type, image_path, tags, location, area, building, floor, specific_location,
+                           date_reported, image_hash)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """, items)
+    cursor.executemany("INSERT INTO item_tags (item_id, tag, confidence) VALUES (?, ?, ?)", tags)
+
+
+def dataset(data_dir, count, images):
+    path = os.path.join(data_dir, f"items-{count}.db")
+    if not os.path.exists(path):
+        start = time.perf_counter()
+        create_dataset(path, count, images)
+        print(f"Generated {count} rows in {time.perf_counter() - start:.1f}s")
+    return path
+
+
+def measure(function, repeat, setup=None):
+    timings = []
+    for _ in range(repeat):
+        argument = setup() if setup else None
+        start = time.perf_counter()
+        function(argument) if setup else function()
+        timings.append((time.perf_counter() - start) * 1000)
+    return {
+        "runs": len(timings),
+        "min_ms": min(timings),
+        "median_ms": statistics.median(timings),
+        "mean_ms": statistics.mean(timings),
+        "max_ms": max(timings),
+    }
+
+
+def query_benchmarks(results, size, repeat):
+    conn = database.connect()
+    try:
+        results[f"query.list_first_page[{size}]"] = measure(
+            lambda: database.fetch_items_page(conn, "Lost", limit=config.LIST_PAGE_SIZE), repeat)
+
+        after = None
+        for _ in range(10):
+            page = database.fetch_items_page(conn, "Lost", after, config.LIST_PAGE_SIZE)
+            if page:
+                after = (page[-1][4], page[-1][0])
+        results[f"query.list_page_10[{size}]"] = measure(
+            lambda: database.fetch_items_page(conn, "Lost", after, config.LIST_PAGE_SIZE), repeat)
+
+        results[f"query.list_tag[{size}]"] = measure(
+            lambda: database.fetch_items_page(conn, "Lost", limit=config.LIST_PAGE_SIZE, tag="laptop"), repeat)
+
+        terms = iter(SEARCH_TERMS * repeat)
+        results[f"query.search[{size}]"] = measure(
+            lambda term: database.search_items_page(conn, "Lost", term, 0, config.LIST_PAGE_SIZE), repeat,
+            setup=lambda: next(terms))
+
+        results[f"query.search_tag[{size}]"] = measure(
+            lambda: database.search_items_page(conn, "Lost", "dome", 0, config.LIST_PAGE_SIZE, "bottle"), repeat)
+
+        results[f"query.tag_facets[{size}]"] = measure(lambda: database.tag_facets(conn, "Lost"), repeat)
+    finally:
+        conn.close()
+
+
+def insert_benchmark(results, size, repeat, images, store_directory):
+    # The same work as submitting a report: store the image, insert the row, score its matches
+    import image_store
+    import matching
+
+    inserted = []
+    area, building, floor, specific_location = "University", "Dome building", "Ground floor", "library desk"
+    location = database.format_location(area, building, floor, specific_location)
+    conn = database.connect()
+    try:
+        def submit(image_path):
+            save_path, _ = image_store.store_image(image_path, store_directory)
+            cursor = conn.cursor()
+            item_id = database.insert_item(cursor, "Lost", save_path, [("backpack", 0.91), ("bottle", 0.88)],
+                                           location, area, building, floor, specific_location)
+            matching.score_item(conn, item_id)
+            conn.commit()
+            inserted.append(item_id)
+
+        paths = iter(images * repeat)
+        results[f"insert.submit[{size}]"] = measure(submit, repeat, setup=lambda: next(paths))
+    finally:
+        # Leave the dataset as it was generated so later runs compare like with like
+        database.executemany_batched(conn.cursor(), "DELETE FROM items WHERE id=?",
+                                     ((item_id,) for item_id in inserted))
+        conn.commit()
+        conn.close()
+
+
+def gui_benchmarks(results, size, repeat):
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    from PyQt5.QtCore import QThreadPool
+    from PyQt5.QtWidgets import QApplication, QListView
+
+    from item_list import ItemDelegate, ItemListModel
+    from thumbnails import setup_thumbnail_cache
+    from workers import query_pool
+
+    app = QApplication.instance() or QApplication([])
+    setup_thumbnail_cache()
+    view = QListView()
+    view.setItemDelegate(ItemDelegate(THUMBNAIL_WIDTH, view))
+    view.setUniformItemSizes(True)
+    view.resize(THUMBNAIL_WIDTH + 60, 1000)
+
+    def wait_for_rows(model):
+        # Pages are queried on the query pool and delivered through the event loop
+        while model.is_loading():
+            query_pool().waitForDone()
+            app.processEvents()
+
+    def first_page():
+        model = ItemListModel("Lost", THUMBNAIL_WIDTH)
+        view.setModel(model)
+        model.set_search("")
+        wait_for_rows(model)
+        view.grab()
+        app.processEvents()
+        return model
+
+    def scroll(model):
+        for _ in range(10):
+            if model.canFetchMore():
+                model.fetchMore()
+                wait_for_rows(model)
+            view.scrollToBottom()
+            view.grab()
+        app.processEvents()
+
+    def settle():
+        # Thumbnail jobs started by one run must not slow down the next
+        QThreadPool.globalInstance().waitForDone()
+        app.processEvents()
+
+    results[f"gui.first_page[{size}]"] = measure(lambda _: first_page(), repeat, setup=settle)
+    results[f"gui.scroll_10_pages[{size}]"] = measure(scroll, repeat, setup=lambda: (settle(), first_page())[1])
+    settle()
+
+
+def similarity_benchmarks(results, size, repeat):
+    import numpy as np
+
+    import embeddings
+
+    # Random unit vectors stand in for real embeddings, only the search cost is measured
+    generator = np.random.default_rng(0)
+    index = embeddings.EmbeddingIndex("benchmark")
+    vectors = generator.standard_normal((size, EMBEDDING_DIMENSIONS), dtype=np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    index.vectors = vectors.astype(np.float16).astype(np.float32)
+    index.ids = np.arange(1, size + 1, dtype=np.int64)
+    index.item_types = np.array(["Lost", "Found"] * (size // 2) + ["Lost"] * (size % 2), dtype=object)
+    index.count = size
+    item_ids = iter(generator.integers(1, size + 1, repeat))
+
+    def find_similar(item_id):
+        index.search(index.vector_for(item_id), config.SIMILAR_ITEMS_LIMIT, "Found", exclude_id=item_id)
+
+    results[f"similarity.search[{size}]"] = measure(find_similar, repeat, setup=lambda: int(next(item_ids)))
+
+
+def inference_benchmarks(results, repeat, data_dir):
+    from image_detection import image_identification
+
+    # Every image is new, so the detection cache cannot answer for it
+    image_dir = os.path.join(data_dir, "inference")
+    os.makedirs(image_dir, exist_ok=True)
+    seeds = iter(range(time.time_ns(), time.time_ns() + repeat + 1))
+
+    def unique_image():
+        seed = next(seeds)
+        return placeholder_image(os.path.join(image_dir, f"{seed}.jpg"), seed)
+
+    results["inference.cold"] = measure(image_identification, 1, setup=unique_image)
+    results["inference.warm"] = measure(image_identification, repeat, setup=unique_image)
+    cached = unique_image()
+    image_identification(cached)
+    results["inference.cached"] = measure(lambda: image_identification(cached), repeat)
+
+
+def environment():
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "cpu_count": os.cpu_count(),
+        "sqlite": sqlite3.sqlite_version,
+        "detection_backend": config.DETECTION_BACKEND,
+        "model_size": config.MODEL_SIZE,
+    }
+
+
+def compare(results, baseline, threshold):
+    regressions = []
+    for name, stats in sorted(results.items()):
+        previous = baseline.get(name)
+        if previous is None:
+            print(f"{name:40} {'':>10}    {stats['median_ms']:10.2f} ms  new")
+            continue
+        change = stats["median_ms"] / previous["median_ms"] - 1 if previous["median_ms"] else 0.0
+        flag = ""
+        if change > threshold:
+            flag = "REGRESSION"
+            regressions.append(name)
+        print(f"{name:40} {previous['median_ms']:10.2f} -> {stats['median_ms']:10.2f} ms  {change:+7.1%} {flag}")
+    return regressions
+
+
+def run(args):
+    os.makedirs(args.data_dir, exist_ok=True)
+    # Thumbnails and stored images are written relative to the working directory
+    os.chdir(args.data_dir)
+    images = placeholder_images(args.data_dir)
+    results = {}
+
+    for size in args.sizes:
+        database.use_database(dataset(args.data_dir, size, images))
+        print(f"Benchmarking {size} rows")
+        query_benchmarks(results, size, args.repeat)
+        insert_benchmark(results, size, args.repeat, images, os.path.join(args.data_dir, "objects"))
+        if not args.skip_gui:
+            gui_benchmarks(results, size, args.repeat)
+    database.use_database(database.DATABASE_FILE)
+
+    if importlib.util.find_spec("numpy") is None:
+        print("numpy is not installed, skipping similarity benchmarks")
+    else:
+        for size in args.sizes:
+            if size <= SIMILARITY_MAX_SIZE:
+                similarity_benchmarks(results, size, args.repeat)
+
+    if not args.skip_inference:
+        if importlib.util.find_spec("ultralytics") is None:
+            print("ultralytics is not installed, skipping inference benchmarks")
+        else:
+            inference_benchmarks(results, args.repeat, args.data_dir)
+
+    report = {"created": datetime.now().isoformat(timespec="seconds"), "environment": environment(),
+              "repeat": args.repeat, "results": results}
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f"{len(regressions)} benchmarks are more than {args.threshold:.0%} slower than the baseline")
+            return 1
+    return 0
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Measure how the app performs as the database grows.")
+    parser.add_argument("--sizes", type=lambda value: [int(size) for size in value.split(",")], default=DEFAULT_SIZES,
+                        help="comma separated dataset sizes, default 1000,10000,100000,1000000")
+    parser.add_argument("--repeat", type=int, default=20, help="timed runs per benchmark")
+    parser.add_argument("--output", default="benchmark_results.json", help="where to write the JSON results")
+    parser.add_argument("--baseline", help="results of an earlier run to compare against")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="median slowdown that counts as a regression, 0.2 means 20%%")
+    parser.add_argument("--data-dir", default=str(database.DATABASE_DIR / "benchmark"),
+                        help="where synthetic datasets are generated and kept between runs")
+    parser.add_argument("--skip-gui", action="store_true", help="skip the offscreen list view benchmarks")
+    parser.add_argument("--skip-inference", action="store_true", help="skip the object detection benchmarks")
+    args = parser.parse_args(argv)
+    args.output = os.path.abspath(args.output)
+    args.baseline = args.baseline and os.path.abspath(args.baseline)
+    args.data_dir = os.path.abspath(args.data_dir)
+    return args
+
+
+if __name__ == "__main__":
+    sys.exit(run(parse_args(sys.argv[1:])))
@@ -0,0 +1,108 @@
+import os
+
+# Every setting can be overridden with an LF_* environment variable
+
+
+def _env_int(name, default):
+    return int(os.environ.get(f"LF_{name}", default))
+
+
+def _env_float(name, default):
+    return float(os.environ.get(f"LF_{name}", default))
+
+
+def _env_bool(name, default):
+    return os.environ.get(f"LF_{name}", "1" if default else "0").lower() not in ("0", "false", "no", "off")
+
+
+# Detection result cache
+DETECTION_CACHE_ENABLED = _env_bool("DETECTION_CACHE", True)
+DETECTION_CACHE_MAX_ENTRIES = _env_int("DETECTION_CACHE_MAX_ENTRIES", 50000)
+
+# Listing thumbnails
+THUMBNAIL_DIRECTORY = os.environ.get("LF_THUMBNAIL_DIRECTORY", os.path.join("saved_items", "thumbnails"))
+THUMBNAIL_QUALITY = _env_int("THUMBNAIL_QUALITY", 85)
+# In-memory budget for decoded thumbnails, in kilobytes
+THUMBNAIL_CACHE_KB = _env_int("THUMBNAIL_CACHE_KB", 64 * 1024)
+
+# Reported items list
+LIST_PAGE_SIZE = _env_int("LIST_PAGE_SIZE", 50)
+
+# Lost/found matching
+MATCH_TAG_WEIGHT = _env_float("MATCH_TAG_WEIGHT", 0.5)
+MATCH_LOCATION_WEIGHT = _env_float("MATCH_LOCATION_WEIGHT", 0.3)
+MATCH_TIME_WEIGHT = _env_float("MATCH_TIME_WEIGHT", 0.2)
+MATCH_TIME_SCALE_DAYS = _env_float("MATCH_TIME_SCALE_DAYS", 14)
+MATCH_WINDOW_DAYS = _env_int("MATCH_WINDOW_DAYS", 90)
+# Most reports sharing a tag that are scored for one report, same building and closest in time first
+MATCH_MAX_CANDIDATES = _env_int("MATCH_MAX_CANDIDATES", 1000)
+MATCH_MIN_SCORE = _env_float("MATCH_MIN_SCORE", 0.5)
+
+# Visual similarity search
+SIMILAR_ITEMS_LIMIT = _env_int("SIMILAR_ITEMS_LIMIT", 50)
+
+# Near duplicate detection, the largest Hamming distance between image hashes still treated as the same photo
+DUPLICATE_MAX_DISTANCE = _env_int("DUPLICATE_MAX_DISTANCE", 6)
+
+# SQLite connections
+SQLITE_POOL_SIZE = _env_int("SQLITE_POOL_SIZE", 4)
+SQLITE_CACHE_KB = _env_int("SQLITE_CACHE_KB", 64 * 1024)
+SQLITE_MMAP_BYTES = _env_int("SQLITE_MMAP_BYTES", 256 * 1024 * 1024)
+SQLITE_BUSY_TIMEOUT_MS = _env_int("SQLITE_BUSY_TIMEOUT_MS", 30000)
+SQLITE_CACHED_STATEMENTS = _env_int("SQLITE_CACHED_STATEMENTS", 256)
+
+# Stored item images, originals larger than IMAGE_MAX_SIDE pixels are downscaled at ingest
+IMAGE_RECOMPRESS = _env_bool("IMAGE_RECOMPRESS", True)
+IMAGE_MAX_SIDE = _env_int("IMAGE_MAX_SIDE", 2048)
+IMAGE_FORMAT = os.environ.get("LF_IMAGE_FORMAT", "JPEG").upper()
+IMAGE_QUALITY = _env_int("IMAGE_QUALITY", 85)
+
+# Object detection model: backend is pytorch, onnx or openvino, size is n, s or m
+DETECTION_BACKEND = os.environ.get("LF_DETECTION_BACKEND", "pytorch").lower()
+MODEL_SIZE = os.environ.get("LF_MODEL_SIZE", "m").lower()
+MODEL_INT8 = _env_bool("MODEL_INT8", False)
+MODEL_DIRECTORY = os.environ.get("LF_MODEL_DIRECTORY", os.path.join(os.path.expanduser("~"), "lost-and-found", "models"))
+# Exported models can't produce embeddings, so similarity search on the onnx and openvino backends
+# loads the PyTorch weights as well. Off by default, it costs the memory the export saves
+EXPORTED_BACKEND_EMBEDDINGS = _env_bool("EXPORTED_BACKEND_EMBEDDINGS", False)
+
+# Timing spans and counters for the submit and browse pipelines, off by default
+METRICS_ENABLED = _env_bool("METRICS", False)
+# Seconds between snapshots written to the rotating metrics log, 0 disables the log
+METRICS_LOG_INTERVAL = _env_int("METRICS_LOG_INTERVAL", 60)
+METRICS_LOG_FILE = os.environ.get("LF_METRICS_LOG_FILE", os.path.join(os.path.expanduser("~"), "lost-and-found", "metrics.log"))
+METRICS_LOG_MAX_BYTES = _env_int("METRICS_LOG_MAX_BYTES", 1024 * 1024)
+METRICS_LOG_BACKUPS = _env_int("METRICS_LOG_BACKUPS", 3)
+# Serves Prometheus text format on http://127.0.0.1:<port>/metrics, 0 disables it
+METRICS_PORT = _env_int("METRICS_PORT", 0)
+
+# Shared detection service, e.g. http://127.0.0.1:8765 or unix:///tmp/lost-and-found.sock.
+# When set the app sends detection and embedding work there instead of loading the model itself
+SERVICE_URL = os.environ.get("LF_SERVICE_URL", "")
+SERVICE_TIMEOUT = _env_float("SERVICE_TIMEOUT", 120.0)
+# Concurrent detection requests are grouped into one model call of up to this many images,
+# waiting at most this long for the batch to fill
+SERVICE_BATCH_SIZE = _env_int("SERVICE_BATCH_SIZE", 8)
+SERVICE_BATCH_WAIT_MS = _env_int("SERVICE_BATCH_WAIT_MS", 10)
+
+# Search as you type waits this long after the last keystroke before querying
+SEARCH_DEBOUNCE_MS = _env_int("SEARCH_DEBOUNCE_MS", 250)
+# A refresh that finds more new rows than this reloads the list instead of prepending them
+REFRESH_MAX_NEW_ROWS = _env_int("REFRESH_MAX_NEW_ROWS", 500)
+
+# Reports older than this many days, and reports marked resolved, are moved to the archive
+RETENTION_DAYS = _env_int("RETENTION_DAYS", 120)
+# Rows moved per transaction, so a large archive run never holds the write lock for long
+RETENTION_BATCH_SIZE = _env_int("RETENTION_BATCH_SIZE", 500)
+COLD_STORAGE_DIRECTORY = os.environ.get("LF_COLD_STORAGE_DIRECTORY", os.path.join("saved_items", "cold"))
+# Archive old reports in the background every time the app starts, off unless asked for
+RETENTION_AUTO = _env_bool("RETENTION_AUTO", False)
+
+# Tiled inference for small items in large photos: images whose longer side is at least
+# TILE_MIN_SIDE pixels are also cut into overlapping tiles, all run through the model in one call
+TILED_INFERENCE = _env_bool("TILED_INFERENCE", False)
+TILE_SIZE = _env_int("TILE_SIZE", 640)
+TILE_OVERLAP = _env_float("TILE_OVERLAP", 0.2)
+TILE_MIN_SIDE = _env_int("TILE_MIN_SIDE", 1280)
+# Tiles grow beyond TILE_SIZE so that no image needs more than this many
+TILE_MAX_COUNT = _env_int("TILE_MAX_COUNT", 12)
@@ -0,0 +1,559 @@
+import os
+import re
+import sqlite3
+import threading
+from pathlib import Path
+
+import config
+
+# Configure database path
+DATABASE_DIR = Path.home() / "lost-and-found"
+DATABASE_DIR.mkdir(exist_ok=True)
+DATABASE_FILE = str(DATABASE_DIR / "reported_items.db")
+# Shortest typed word that is searched for
+SEARCH_MIN_PREFIX = 2
+
+
+def open_connection(path=DATABASE_FILE):
+    conn = sqlite3.connect(path, timeout=config.SQLITE_BUSY_TIMEOUT_MS / 1000, check_same_thread=False,
+                           cached_statements=config.SQLITE_CACHED_STATEMENTS)
+    # WAL lets readers carry on while another connection is writing
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA cache_size=-{config.SQLITE_CACHE_KB}")
+    conn.execute(f"PRAGMA mmap_size={config.SQLITE_MMAP_BYTES}")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    return conn
+
+
+class PooledConnection:
+    # Behaves like a sqlite3 connection, except that close() hands it back to the pool
+    def __init__(self, pool, conn):
+        self._pool = pool
+        self._conn = conn
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def __enter__(self):
+        self._conn.__enter__()
+        return self
+
+    def __exit__(self, *exc_info):
+        return self._conn.__exit__(*exc_info)
+
+    def close(self):
+        if self._conn is not None:
+            self._pool.release(self._conn)
+            self._conn = None
+
+
+class ConnectionPool:
+    def __init__(self, path=DATABASE_FILE, size=config.SQLITE_POOL_SIZE):
+        self.path = path
+        self.size = size
+        self._idle = []
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    def acquire(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                # Connections must not cross a fork, worker processes start with an empty pool
+                self._idle = []
+                self._pid = os.getpid()
+            conn = self._idle.pop() if self._idle else None
+        if conn is None:
+            conn = open_connection(self.path)
+        return PooledConnection(self, conn)
+
+    def release(self, conn):
+        if conn.in_transaction:
+            conn.rollback()
+        with self._lock:
+            if self._pid == os.getpid() and len(self._idle) < self.size:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+    def close_all(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+
+_pool = ConnectionPool()
+
+
+def connect():
+    return _pool.acquire()
+
+
+def database_path():
+    return _pool.path
+
+
+def use_database(path):
+    # Points connect() at another database file, e.g. a synthetic one for benchmarks
+    global _pool
+    _pool.close_all()
+    _pool = ConnectionPool(path)
+
+
+def executemany_batched(cursor, sql, rows, batch_size=1000):
+    # Streams rows through executemany without building one huge list
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= batch_size:
+            cursor.executemany(sql, batch)
+            batch = []
+    if batch:
+        cursor.executemany(sql, batch)
+
+
+def migrate(conn):
+    # Applies every migration newer than the version recorded in the database
+    conn.execute("CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)")
+    current = conn.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version").fetchone()[0]
+    for version, migration in MIGRATIONS:
+        if version <= current:
+            continue
+        try:
+            migration(conn)
+            conn.execute("INSERT INTO schema_version (version) VALUES (?)", (version,))
+            conn.commit()
+        except sqlite3.Error:
+            conn.rollback()
+            raise
+
+
+def create_items_table(conn):
+    cursor = conn.cursor()
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS items (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            item_type TEXT NOT NULL,
+            image_path TEXT NOT NULL,
+            tags TEXT,
+            location TEXT,
+            area TEXT,
+            building TEXT,
+            floor TEXT,
+            specific_location TEXT,
+            date_reported TEXT DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    # Source files already registered by a bulk ingest, so an interrupted run can resume
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS ingested_files (
+            source_path TEXT PRIMARY KEY,
+            item_id INTEGER NOT NULL,
+            date_ingested TEXT DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+
+
+def has_table(conn, name):
+    row = conn.execute("SELECT 1 FROM sqlite_master WHERE name=?", (name,)).fetchone()
+    return row is not None
+
+
+def create_search_index(conn):
+    # Full text index over the searchable columns, kept in sync with items by triggers
+    exists = has_table(conn, "items_fts")
+    try:
+        conn.execute("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS items_fts USING fts5(
+                tags, location, building, specific_location,
+                content='items', content_rowid='id', prefix='2 3'
+            )
+        """)
+    except sqlite3.OperationalError as e:
+        # SQLite built without FTS5, searching falls back to LIKE
+        print(f"Full text search unavailable: {e}")
+        return
+
+    conn.executescript("""
+        CREATE TRIGGER IF NOT EXISTS items_fts_insert AFTER INSERT ON items BEGIN
+            INSERT INTO items_fts (rowid, tags, location, building, specific_location)
+            VALUES (new.id, new.tags, new.location, new.building, new.specific_location);
+        END;
+        CREATE TRIGGER IF NOT EXISTS items_fts_delete AFTER DELETE ON items BEGIN
+            INSERT INTO items_fts (items_fts, rowid, tags, location, building, specific_location)
+            VALUES ('delete', old.id, old.tags, old.location, old.building, old.specific_location);
+        END;
+        CREATE TRIGGER IF NOT EXISTS items_fts_update AFTER UPDATE ON items BEGIN
+            INSERT INTO items_fts (items_fts, rowid, tags, location, building, specific_location)
+            VALUES ('delete', old.id, old.tags, old.location, old.building, old.specific_location);
+            INSERT INTO items_fts (rowid, tags, location, building, specific_location)
+            VALUES (new.id, new.tags, new.location, new.building, new.specific_location);
+        END;
+    """)
+    if not exists:
+        # Databases created before the index existed need their rows indexed once
+        conn.execute("INSERT INTO items_fts (items_fts) VALUES ('rebuild')")
+
+
+def create_item_tags(conn):
+    conn.executescript("""
+        CREATE TABLE IF NOT EXISTS item_tags (
+            item_id INTEGER NOT NULL,
+            tag TEXT NOT NULL,
+            confidence REAL,
+            PRIMARY KEY (item_id, tag)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS idx_item_tags_tag ON item_tags (tag, item_id);
+        CREATE INDEX IF NOT EXISTS idx_items_type_date ON items (item_type, date_reported);
+        CREATE TRIGGER IF NOT EXISTS item_tags_delete AFTER DELETE ON items BEGIN
+            DELETE FROM item_tags WHERE item_id = old.id;
+        END;
+    """)
+    # Split the comma joined tags of existing rows, their confidence was never stored
+    rows = conn.execute("SELECT id, tags FROM items WHERE tags IS NOT NULL AND tags != ''")
+    conn.executemany(
+        "INSERT OR IGNORE INTO item_tags (item_id, tag) VALUES (?, ?)",
+        ((item_id, tag) for item_id, tags in rows for tag in tags.split(",") if tag))
+
+
+def create_matches(conn):
+    conn.executescript("""
+        CREATE TABLE IF NOT EXISTS matches (
+            lost_id INTEGER NOT NULL,
+            found_id INTEGER NOT NULL,
+            score REAL NOT NULL,
+            date_matched TEXT DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (lost_id, found_id)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS idx_matches_found ON matches (found_id);
+        CREATE INDEX IF NOT EXISTS idx_items_place ON items (item_type, area, building, date_reported);
+        CREATE TRIGGER IF NOT EXISTS matches_delete AFTER DELETE ON items BEGIN
+            DELETE FROM matches WHERE lost_id = old.id OR found_id = old.id;
+        END;
+    """)
+
+
+def create_item_embeddings(conn):
+    conn.executescript("""
+        CREATE TABLE IF NOT EXISTS item_embeddings (
+            item_id INTEGER PRIMARY KEY,
+            model TEXT NOT NULL,
+            vector BLOB NOT NULL
+        );
+        CREATE TRIGGER IF NOT EXISTS item_embeddings_delete AFTER DELETE ON items BEGIN
+            DELETE FROM item_embeddings WHERE item_id = old.id;
+        END;
+    """)
+
+
+def add_image_hash(conn):
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(items)")]
+    if "image_hash" not in columns:
+        conn.execute("ALTER TABLE items ADD COLUMN image_hash INTEGER")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_items_image_hash ON items (image_hash)")
+
+
+def create_items_archive(conn):
+    # Old and resolved reports are moved here by retention.py, out of the way of everyday queries
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(items)")]
+    if "resolved" not in columns:
+        conn.execute("ALTER TABLE items ADD COLUMN resolved INTEGER NOT NULL DEFAULT 0")
+    conn.executescript("""
+        CREATE INDEX IF NOT EXISTS idx_items_resolved ON items (resolved) WHERE resolved = 1;
+        CREATE INDEX IF NOT EXISTS idx_items_image_path ON items (image_path);
+        CREATE TABLE IF NOT EXISTS items_archive (
+            id INTEGER PRIMARY KEY,
+            item_type TEXT NOT NULL,
+            image_path TEXT NOT NULL,
+            tags TEXT,
+            location TEXT,
+            area TEXT,
+            building TEXT,
+            floor TEXT,
+            specific_location TEXT,
+            date_reported TEXT,
+            image_hash INTEGER,
+            resolved INTEGER NOT NULL DEFAULT 0,
+            date_archived TEXT DEFAULT CURRENT_TIMESTAMP
+        );
+        CREATE INDEX IF NOT EXISTS idx_items_archive_type_date ON items_archive (item_type, date_reported);
+        CREATE INDEX IF NOT EXISTS idx_items_archive_image_path ON items_archive (image_path);
+    """)
+    if not has_table(conn, "items_fts"):
+        return
+    conn.executescript("""
+        CREATE VIRTUAL TABLE IF NOT EXISTS items_archive_fts USING fts5(
+            tags, location, building, specific_location,
+            content='items_archive', content_rowid='id', prefix='2 3'
+        );
+        CREATE TRIGGER IF NOT EXISTS items_archive_fts_insert AFTER INSERT ON items_archive BEGIN
+            INSERT INTO items_archive_fts (rowid, tags, location, building, specific_location)
+            VALUES (new.id, new.tags, new.location, new.building, new.specific_location);
+        END;
+        CREATE TRIGGER IF NOT EXISTS items_archive_fts_delete AFTER DELETE ON items_archive BEGIN
+            INSERT INTO items_archive_fts (items_archive_fts, rowid, tags, location, building, specific_location)
+            VALUES ('delete', old.id, old.tags, old.location, old.building, old.specific_location);
+        END;
+        CREATE TRIGGER IF NOT EXISTS items_archive_fts_update AFTER UPDATE OF tags, location, building, specific_location
+        ON items_archive BEGIN
+            INSERT INTO items_archive_fts (items_archive_fts, rowid, tags, location, building, specific_location)
+            VALUES ('delete', old.id, old.tags, old.location, old.building, old.specific_location);
+            INSERT INTO items_archive_fts (rowid, tags, location, building, specific_location)
+            VALUES (new.id, new.tags, new.location, new.building, new.specific_location);
+        END;
+    """)
+
+
+def keep_archived_links(conn):
+    # Rows moved to items_archive keep their tags, matches and embeddings, those are only
+    # cleaned up once a report is gone from both tables
+    kept = "NOT EXISTS (SELECT 1 FROM items_archive WHERE id = old.id)"
+    gone = "NOT EXISTS (SELECT 1 FROM items WHERE id = old.id)"
+    conn.executescript(f"""
+        DROP TRIGGER IF EXISTS item_tags_delete;
+        DROP TRIGGER IF EXISTS matches_delete;
+        DROP TRIGGER IF EXISTS item_embeddings_delete;
+        CREATE TRIGGER item_tags_delete AFTER DELETE ON items WHEN {kept} BEGIN
+            DELETE FROM item_tags WHERE item_id = old.id;
+        END;
+        CREATE TRIGGER matches_delete AFTER DELETE ON items WHEN {kept} BEGIN
+            DELETE FROM matches WHERE lost_id = old.id OR found_id = old.id;
+        END;
+        CREATE TRIGGER item_embeddings_delete AFTER DELETE ON items WHEN {kept} BEGIN
+            DELETE FROM item_embeddings WHERE item_id = old.id;
+        END;
+        CREATE TRIGGER IF NOT EXISTS items_archive_links_delete AFTER DELETE ON items_archive WHEN {gone} BEGIN
+            DELETE FROM item_tags WHERE item_id = old.id;
+            DELETE FROM matches WHERE lost_id = old.id OR found_id = old.id;
+            DELETE FROM item_embeddings WHERE item_id = old.id;
+        END;
+    """)
+
+
+def narrow_search_update_trigger(conn):
+    # Only changes to the indexed columns touch the index, marking a report resolved no longer
+    # rewrites its search terms
+    if not has_table(conn, "items_fts"):
+        return
+    conn.executescript("""
+        DROP TRIGGER IF EXISTS items_fts_update;
+        CREATE TRIGGER items_fts_update AFTER UPDATE OF tags, location, building, specific_location
+        ON items BEGIN
+            INSERT INTO items_fts (items_fts, rowid, tags, location, building, specific_location)
+            VALUES ('delete', old.id, old.tags, old.location, old.building, old.specific_location);
+            INSERT INTO items_fts (rowid, tags, location, building, specific_location)
+            VALUES (new.id, new.tags, new.location, new.building, new.specific_location);
+        END;
+    """)
+
+
+def create_tag_counts(conn):
+    # Tag counts of the current reports per item type, kept up to date by triggers so the tag
+    # facets never have to count item_tags. Counts are taken before a report leaves items, for
+    # good or into the archive, while its tags are still there
+    conn.executescript("""
+        CREATE TABLE IF NOT EXISTS tag_counts (
+            item_type TEXT NOT NULL,
+            tag TEXT NOT NULL,
+            count INTEGER NOT NULL,
+            PRIMARY KEY (item_type, tag)
+        ) WITHOUT ROWID;
+        CREATE TRIGGER IF NOT EXISTS tag_counts_insert AFTER INSERT ON item_tags BEGIN
+            INSERT INTO tag_counts (item_type, tag, count)
+            SELECT item_type, new.tag, 1 FROM items WHERE id = new.item_id
+            ON CONFLICT (item_type, tag) DO UPDATE SET count = count + 1;
+        END;
+        CREATE TRIGGER IF NOT EXISTS tag_counts_delete AFTER DELETE ON item_tags BEGIN
+            UPDATE tag_counts SET count = count - 1
+            WHERE tag = old.tag AND item_type = (SELECT item_type FROM items WHERE id = old.item_id);
+        END;
+        CREATE TRIGGER IF NOT EXISTS tag_counts_item_delete BEFORE DELETE ON items BEGIN
+            UPDATE tag_counts SET count = count - 1
+            WHERE item_type = old.item_type AND tag IN (SELECT tag FROM item_tags WHERE item_id = old.id);
+        END;
+        CREATE TRIGGER IF NOT EXISTS tag_counts_item_type AFTER UPDATE OF item_type ON items BEGIN
+            UPDATE tag_counts SET count = count - 1
+            WHERE item_type = old.item_type AND tag IN (SELECT tag FROM item_tags WHERE item_id = old.id);
+            INSERT INTO tag_counts (item_type, tag, count)
+            SELECT new.item_type, tag, 1 FROM item_tags WHERE item_id = new.id
+            ON CONFLICT (item_type, tag) DO UPDATE SET count = count + 1;
+        END;
+        DELETE FROM tag_counts;
+        INSERT INTO tag_counts (item_type, tag, count)
+        SELECT items.item_type, item_tags.tag, COUNT(*)
+        FROM item_tags
+        JOIN items ON items.id = item_tags.item_id
+        GROUP BY items.item_type, item_tags.tag;
+    """)
+
+
+MIGRATIONS = [
+    (1, create_items_table),
+    (2, create_search_index),
+    (3, create_item_tags),
+    (4, create_matches),
+    (5, create_item_embeddings),
+    (6, add_image_hash),
+    (7, create_items_archive),
+    (8, keep_archived_links),
+    (9, narrow_search_update_trigger),
+    (10, create_tag_counts),
+]
+
+
+def format_location(area, building, floor, specific_location):
+    location = f"{area}, {building}"
+    if floor and floor != "Not applicable":
+        location += f", {floor}"
+    location += f", {specific_location}"
+    return location
+
+
+def insert_item(cursor, item_type, image_path, detections, location, area, building, floor, specific_location,
+                image_hash=None):
+    tags = [tag for tag, _ in detections]
+    cursor.execute("""
+        INSERT INTO items (item_type, image_path, tags, location, area, building, floor, specific_location, image_hash)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """, (item_type, image_path, ",".join(tags), location, area, building, floor, specific_location, image_hash))
+    item_id = cursor.lastrowid
+    cursor.executemany("""
+        INSERT INTO item_tags (item_id, tag, confidence) VALUES (?, ?, ?)
+        ON CONFLICT (item_id, tag) DO UPDATE SET confidence = MAX(confidence, excluded.confidence)
+    """, [(item_id, tag, confidence) for tag, confidence in detections])
+    return item_id
+
+
+def partitions(conn, include_archived):
+    # The tables a listing or search reads, archived reports only when asked for
+    if include_archived and has_table(conn, "items_archive"):
+        return ["items", "items_archive"]
+    return ["items"]
+
+
+def tag_condition(table, tag):
+    if not tag:
+        return "", []
+    return f" AND {table}.id IN (SELECT item_id FROM item_tags WHERE tag=?)", [tag]
+
+
+def fetch_items_page(conn, item_type, after=None, limit=50, tag=None, include_archived=False):
+    # Keyset pagination on (date_reported, id): `after` is the key of the last row already shown
+    selects = []
+    params = []
+    for table in partitions(conn, include_archived):
+        tag_filter, tag_params = tag_condition(table, tag)
+        query = f"""
+            SELECT id, image_path, tags, location, date_reported
+            FROM {table}
+            WHERE item_type=?{tag_filter}
+        """
+        params += [item_type] + tag_params
+        if after:
+            query += " AND (date_reported, id) < (?, ?)"
+            params += list(after)
+        selects.append(query)
+    query = " UNION ALL ".join(selects) + " ORDER BY date_reported DESC, id DESC LIMIT ?"
+    params.append(limit)
+    return conn.execute(query, params).fetchall()
+
+
+def search_query(search_term):
+    # Every word has to match as a prefix, so partially typed words still find results. Single
+    # letters are left out, the index only holds prefixes of two and three characters and a
+    # one letter prefix would have to scan every term
+    words = [word for word in re.findall(r"\w+", search_term.lower()) if len(word) >= SEARCH_MIN_PREFIX]
+    return " ".join(f'"{word}"*' for word in words)
+
+
+def search_items_page(conn, item_type, search_term, offset=0, limit=50, tag=None, include_archived=False):
+    # Results are ranked by relevance, so they are paged by offset rather than by key.
+    # Archived matches are listed after every current one
+    match = search_query(search_term)
+    if not match:
+        if offset:
+            return []
+        return fetch_items_page(conn, item_type, limit=limit, tag=tag, include_archived=include_archived)
+
+    use_fts = has_table(conn, "items_fts")
+    selects = []
+    params = []
+    for partition, table in enumerate(partitions(conn, include_archived)):
+        tag_filter, tag_params = tag_condition(table, tag)
+        if use_fts:
+            selects.append(f"""
+                SELECT {table}.id, {table}.image_path, {table}.tags, {table}.location, {table}.date_reported,
+                       {partition} AS partition, bm25({table}_fts, 10.0, 2.0, 1.0, 1.0) AS rank
+                FROM {table}_fts
+                JOIN {table} ON {table}.id = {table}_fts.rowid
+                WHERE {table}_fts MATCH ? AND {table}.item_type=?{tag_filter}
+            """)
+            params += [match, item_type] + tag_params
+        else:
+            selects.append(f"""
+                SELECT id, image_path, tags, location, date_reported, {partition} AS partition, 0 AS rank
+                FROM {table}
+                WHERE item_type=? AND (LOWER(tags) LIKE ? OR LOWER(location) LIKE ?){tag_filter}
+            """)
+            params += [item_type, f"%{search_term}%", f"%{search_term}%"] + tag_params
+
+    rows = conn.execute(" UNION ALL ".join(selects) + """
+        ORDER BY partition, rank, date_reported DESC, id DESC
+        LIMIT ? OFFSET ?
+    """, params + [limit, offset]).fetchall()
+    return [row[:5] for row in rows]
+
+
+def fetch_items_newer(conn, item_type, newest, search_term="", tag=None, limit=500):
+    # Rows reported after `newest`, the (date_reported, id) key of the newest row already shown
+    query = """
+        SELECT id, image_path, tags, location, date_reported
+        FROM items
+        WHERE item_type=? AND (date_reported, id) > (?, ?)
+    """
+    params = [item_type] + list(newest)
+    match = search_query(search_term)
+    if match and has_table(conn, "items_fts"):
+        query += " AND id IN (SELECT rowid FROM items_fts WHERE items_fts MATCH ?)"
+        params.append(match)
+    elif match:
+        query += " AND (LOWER(tags) LIKE ? OR LOWER(location) LIKE ?)"
+        params += [f"%{search_term}%", f"%{search_term}%"]
+    if tag:
+        query += " AND id IN (SELECT item_id FROM item_tags WHERE tag=?)"
+        params.append(tag)
+    query += " ORDER BY date_reported DESC, id DESC LIMIT ?"
+    params.append(limit)
+    return conn.execute(query, params).fetchall()
+
+
+def mark_resolved(conn, item_id):
+    # Resolved reports are archived by the next retention run
+    conn.execute("UPDATE items SET resolved=1 WHERE id=?", (item_id,))
+    if has_table(conn, "items_archive"):
+        conn.execute("UPDATE items_archive SET resolved=1 WHERE id=?", (item_id,))
+
+
+def fetch_items_by_ids(conn, item_ids):
+    # Rows come back in the order of item_ids
+    if not item_ids:
+        return []
+    placeholders = ",".join("?" * len(item_ids))
+    rows = conn.execute(f"""
+        SELECT id, image_path, tags, location, date_reported
+        FROM items WHERE id IN ({placeholders})
+    """, list(item_ids)).fetchall()
+    by_id = {row[0]: row for row in rows}
+    return [by_id[item_id] for item_id in item_ids if item_id in by_id]
+
+
+def tag_facets(conn, item_type, limit=20):
+    # Most common tags for one item type, read from the counts the triggers keep
+    return conn.execute("""
+        SELECT tag, count
+        FROM tag_counts
+        WHERE item_type=? AND count > 0
+        ORDER BY count DESC, tag
+        LIMIT ?
+    """, (item_type, limit)).fetchall()
@@ -0,0 +1,98 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+import config
+import database
+
+CACHE_FILE = str(database.DATABASE_DIR / "detection_cache.db")
+
+_fingerprints = {}
+_fingerprints_lock = threading.Lock()
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def weights_fingerprint(path):
+    # Hashing the weights is slow, so only redo it when the file changes on disk
+    if not os.path.exists(path):
+        return None
+    stat = os.stat(path)
+    signature = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    with _fingerprints_lock:
+        if signature not in _fingerprints:
+            _fingerprints[signature] = file_sha256(path)
+        return _fingerprints[signature]
+
+
+class DetectionCache:
+    def __init__(self, path=CACHE_FILE, max_entries=config.DETECTION_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self.conn = database.open_connection(path)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS detection_cache (
+                key TEXT PRIMARY KEY,
+                detections TEXT NOT NULL,
+                last_used REAL NOT NULL
+            )
+        """)
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_detection_cache_last_used ON detection_cache (last_used)")
+        self.conn.commit()
+        self.size = self.conn.execute("SELECT COUNT(*) FROM detection_cache").fetchone()[0]
+
+    @staticmethod
+    def make_key(image_sha256, model_identity, threshold):
+        return f"{image_sha256}:{model_identity}:{threshold}"
+
+    def get(self, key):
+        with self._lock:
+            row = self.conn.execute("SELECT detections FROM detection_cache WHERE key=?", (key,)).fetchone()
+            if row is None:
+                return None
+            self.conn.execute("UPDATE detection_cache SET last_used=? WHERE key=?", (time.time(), key))
+            self.conn.commit()
+            return [tuple(detection) for detection in json.loads(row[0])]
+
+    def put(self, key, detections):
+        with self._lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO detection_cache (key, detections, last_used) VALUES (?, ?, ?)",
+                (key, json.dumps(detections), time.time()))
+            self.size += 1
+            if self.size > self.max_entries:
+                # Replaced keys make the running count drift upwards, so recount before evicting
+                self.size = self.conn.execute("SELECT COUNT(*) FROM detection_cache").fetchone()[0]
+                if self.size > self.max_entries:
+                    self._evict()
+            self.conn.commit()
+
+    def _evict(self):
+        # Drop the least recently used tenth so eviction doesn't run on every insert
+        excess = self.size - self.max_entries + max(1, self.max_entries // 10)
+        self.conn.execute("""
+            DELETE FROM detection_cache WHERE key IN (
+                SELECT key FROM detection_cache ORDER BY last_used LIMIT ?
+            )
+        """, (excess,))
+        self.size = self.conn.execute("SELECT COUNT(*) FROM detection_cache").fetchone()[0]
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = DetectionCache()
+        return _cache
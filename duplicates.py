@@ -0,0 +1,169 @@
+import argparse
+import sys
+import threading
+
+import config
+import database
+
+HASH_SIZE = 8
+
+
+def image_hash(image_path):
+    # 64 bit difference hash: compares neighbouring pixels of a 9x8 greyscale thumbnail
+    from PIL import Image
+
+    with Image.open(image_path) as image:
+        # Lets the JPEG decoder skip most of the full resolution image
+        image.draft("L", (HASH_SIZE * 8, HASH_SIZE * 8))
+        pixels = list(image.convert("L").resize((HASH_SIZE + 1, HASH_SIZE), Image.LANCZOS).getdata())
+
+    value = 0
+    for row in range(HASH_SIZE):
+        for column in range(HASH_SIZE):
+            left = pixels[row * (HASH_SIZE + 1) + column]
+            right = pixels[row * (HASH_SIZE + 1) + column + 1]
+            value = (value << 1) | (left > right)
+    return value
+
+
+def to_signed(value):
+    # SQLite integers are signed 64 bit
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+
+def from_signed(value):
+    return value + (1 << 64) if value < 0 else value
+
+
+def hamming_distance(a, b):
+    return bin(a ^ b).count("1")
+
+
+class BKTree:
+    # Burkhard-Keller tree over Hamming distance, lookups only visit subtrees that can be within range
+    def __init__(self):
+        self.root = None
+        self.size = 0
+
+    def add(self, value, item):
+        self.size += 1
+        if self.root is None:
+            self.root = [value, [item], {}]
+            return
+        node = self.root
+        while True:
+            distance = hamming_distance(value, node[0])
+            if distance == 0:
+                node[1].append(item)
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [value, [item], {}]
+                return
+            node = child
+
+    def search(self, value, max_distance):
+        results = []
+        stack = [self.root] if self.root else []
+        while stack:
+            node = stack.pop()
+            distance = hamming_distance(value, node[0])
+            if distance <= max_distance:
+                results += [(item, distance) for item in node[1]]
+            for child_distance, child in node[2].items():
+                if distance - max_distance <= child_distance <= distance + max_distance:
+                    stack.append(child)
+        return results
+
+
+_tree = None
+_tree_lock = threading.Lock()
+
+
+def get_tree():
+    global _tree
+    with _tree_lock:
+        if _tree is None:
+            tree = BKTree()
+            conn = database.connect()
+            try:
+                cursor = conn.execute("SELECT id, item_type, image_hash FROM items WHERE image_hash IS NOT NULL")
+                for item_id, item_type, value in cursor:
+                    tree.add(from_signed(value), (item_id, item_type))
+            finally:
+                conn.close()
+            _tree = tree
+        return _tree
+
+
+def add_to_tree(item_id, item_type, value):
+    with _tree_lock:
+        if _tree is not None:
+            _tree.add(value, (item_id, item_type))
+
+
+def find_near_duplicates(value, item_type=None, max_distance=config.DUPLICATE_MAX_DISTANCE):
+    tree = get_tree()
+    with _tree_lock:
+        matches = tree.search(value, max_distance)
+    matches = [(item_id, distance) for (item_id, other_type), distance in matches
+               if item_type is None or other_type == item_type]
+    return sorted(matches, key=lambda match: (match[1], match[0]))
+
+
+def backfill_hashes(conn):
+    rows = conn.execute("SELECT id, image_path FROM items WHERE image_hash IS NULL").fetchall()
+    hashes = []
+    for item_id, image_path in rows:
+        try:
+            hashes.append((to_signed(image_hash(image_path)), item_id))
+        except OSError as e:
+            print(f"Could not hash image of item {item_id}: {e}")
+    database.executemany_batched(conn.cursor(), "UPDATE items SET image_hash=? WHERE id=?", hashes)
+    conn.commit()
+    return len(hashes)
+
+
+def duplicate_report(max_distance=config.DUPLICATE_MAX_DISTANCE):
+    global _tree
+    conn = database.connect()
+    try:
+        database.migrate(conn)
+        hashed = backfill_hashes(conn)
+        if hashed:
+            print(f"Hashed {hashed} images")
+            with _tree_lock:
+                _tree = None
+        rows = conn.execute("""
+            SELECT id, item_type, image_hash, image_path, date_reported FROM items
+            WHERE image_hash IS NOT NULL ORDER BY id
+        """).fetchall()
+    finally:
+        conn.close()
+
+    details = {row[0]: row for row in rows}
+    seen = set()
+    groups = 0
+    for item_id, item_type, value, _, _ in rows:
+        if item_id in seen:
+            continue
+        group = [match for match, _ in find_near_duplicates(from_signed(value), item_type, max_distance)]
+        seen.update(group)
+        if len(group) < 2:
+            continue
+        groups += 1
+        print(f"{item_type} items that look alike:")
+        for match in group:
+            print(f"    #{match} {details[match][3]} (reported {details[match][4]})")
+    print(f"{groups} groups of near duplicates among {len(rows)} items")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Find reported items with near identical images.")
+    parser.add_argument("--report", action="store_true", help="list groups of near duplicate items")
+    parser.add_argument("--max-distance", type=int, default=config.DUPLICATE_MAX_DISTANCE)
+    args = parser.parse_args(sys.argv[1:])
+    if args.report:
+        duplicate_report(args.max_distance)
+    else:
+        parser.print_help()
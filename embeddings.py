@@ -0,0 +1,187 @@
+import argparse
+import sys
+import threading
+
+import numpy as np
+
+import database
+
+
+def to_blob(vector):
+    vector = np.asarray(vector, dtype=np.float32).ravel()
+    norm = np.linalg.norm(vector)
+    if norm > 0:
+        vector = vector / norm
+    # Normalised float16 halves the storage and makes cosine similarity a dot product
+    return vector.astype(np.float16).tobytes()
+
+
+def from_blob(blob):
+    return np.frombuffer(blob, dtype=np.float16)
+
+
+def save_embedding(cursor, item_id, vector, model):
+    save_embeddings(cursor, [(item_id, vector)], model)
+
+
+def save_embeddings(cursor, vectors, model):
+    database.executemany_batched(cursor, "INSERT OR REPLACE INTO item_embeddings (item_id, model, vector) VALUES (?, ?, ?)",
+                                 ((item_id, model, to_blob(vector)) for item_id, vector in vectors))
+
+
+class EmbeddingIndex:
+    # Holds the embeddings of one model only, vectors of different models don't compare.
+    # They are kept as float32 so a query is a single matrix product, at twice the memory of the blobs
+    def __init__(self, model):
+        self.model = model
+        self.ids = np.empty(0, dtype=np.int64)
+        self.item_types = np.empty(0, dtype=object)
+        self.vectors = None
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def load(self, conn):
+        with self._lock:
+            self.count = 0
+            cursor = conn.execute("""
+                SELECT item_embeddings.item_id, items.item_type, item_embeddings.vector
+                FROM item_embeddings
+                JOIN items ON items.id = item_embeddings.item_id
+                WHERE item_embeddings.model = ?
+                ORDER BY item_embeddings.item_id
+            """, (self.model,))
+            while True:
+                rows = cursor.fetchmany(4096)
+                if not rows:
+                    break
+                for item_id, item_type, blob in rows:
+                    self._append(item_id, item_type, from_blob(blob))
+
+    def add(self, item_id, item_type, vector, model):
+        if model != self.model:
+            return
+        with self._lock:
+            self._append(item_id, item_type, from_blob(to_blob(vector)))
+
+    def _append(self, item_id, item_type, vector):
+        if self.vectors is None:
+            self.vectors = np.empty((1024, vector.shape[0]), dtype=np.float32)
+            self.ids = np.empty(1024, dtype=np.int64)
+            self.item_types = np.empty(1024, dtype=object)
+            self.count = 0
+        elif self.vectors.shape[1] != vector.shape[0]:
+            raise ValueError(f"Embedding of item {item_id} has {vector.shape[0]} dimensions, "
+                             f"{self.model} embeddings have {self.vectors.shape[1]}")
+        if self.count == len(self.ids):
+            # Grow geometrically so adding one item at a time stays cheap
+            capacity = len(self.ids) * 2
+            self.vectors = np.resize(self.vectors, (capacity, self.vectors.shape[1]))
+            self.ids = np.resize(self.ids, capacity)
+            self.item_types = np.resize(self.item_types, capacity)
+        self.vectors[self.count] = vector
+        self.ids[self.count] = item_id
+        self.item_types[self.count] = item_type
+        self.count += 1
+
+    def vector_for(self, item_id):
+        with self._lock:
+            positions = np.flatnonzero(self.ids[:self.count] == item_id)
+            return self.vectors[positions[0]].copy() if len(positions) else None
+
+    def search(self, vector, k=50, item_type=None, exclude_id=None):
+        query = np.asarray(vector, dtype=np.float32).ravel()
+        query /= np.linalg.norm(query) or 1.0
+
+        with self._lock:
+            if not self.count or query.shape[0] != self.vectors.shape[1]:
+                return []
+            scores = self.vectors[:self.count] @ query
+            ids = self.ids[:self.count]
+            if item_type is not None:
+                scores[self.item_types[:self.count] != item_type] = -np.inf
+            if exclude_id is not None:
+                scores[ids == exclude_id] = -np.inf
+
+        k = min(k, len(scores))
+        if k == 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(int(ids[i]), float(scores[i])) for i in top if np.isfinite(scores[i])]
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def current_model():
+    from image_detection import get_detector
+
+    return get_detector().embedding_name
+
+
+def get_index():
+    global _index
+    with _index_lock:
+        if _index is None:
+            conn = database.connect()
+            try:
+                index = EmbeddingIndex(current_model())
+                index.load(conn)
+            finally:
+                conn.close()
+            _index = index
+        return _index
+
+
+def find_similar(item_id, item_type=None, k=50):
+    index = get_index()
+    vector = index.vector_for(item_id)
+    if vector is None:
+        return []
+    return index.search(vector, k, item_type, exclude_id=item_id)
+
+
+def add_to_index(item_id, item_type, vector, model):
+    # An index that hasn't been loaded yet will read the new row from the database
+    with _index_lock:
+        index = _index
+    if index is not None:
+        index.add(item_id, item_type, vector, model)
+
+
+def backfill(batch_size=16):
+    from image_detection import get_detector
+
+    detector = get_detector()
+    if not detector.can_embed():
+        print(f"Embeddings are disabled for the {detector.backend.format} backend, "
+              f"set LF_EXPORTED_BACKEND_EMBEDDINGS=1 to enable them")
+        return
+    conn = database.connect()
+    try:
+        database.migrate(conn)
+        rows = conn.execute("""
+            SELECT id, image_path FROM items
+            WHERE id NOT IN (SELECT item_id FROM item_embeddings)
+            ORDER BY id
+        """).fetchall()
+        for start in range(0, len(rows), batch_size):
+            batch = rows[start:start + batch_size]
+            vectors = detector.embed(image_path for _, image_path in batch)
+            save_embeddings(conn.cursor(), zip((item_id for item_id, _ in batch), vectors), detector.embedding_name)
+            conn.commit()
+            print(f"{start + len(batch)}/{len(rows)} items embedded")
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Image embeddings for visual similarity search.")
+    parser.add_argument("--backfill", action="store_true", help="embed items that have no embedding yet")
+    parser.add_argument("--batch-size", type=int, default=16)
+    args = parser.parse_args(sys.argv[1:])
+    if args.backfill:
+        backfill(args.batch_size)
+    else:
+        parser.print_help()
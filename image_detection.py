@@ -1,27 +1,548 @@
-from ultralytics import YOLO
+import argparse
+import glob
+import math
+import os
+import shutil
 import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import config
+import database
+import duplicates
+import image_store
+import matching
+import metrics
+from detection_cache import file_sha256, get_cache, weights_fingerprint
+
+CONFIDENCE_THRESHOLD = 0.85
+WARMUP_SIZE = 640
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp", ".gif")
+# Bulk ingest downscales decoded images before handing them to the model
+INGEST_MAX_SIDE = 1280
+# Boxes from neighbouring tiles are the same item when they overlap this much, or when
+# this share of the smaller box lies inside the other one, e.g. an item cut by a tile edge
+TILE_NMS_IOU = 0.5
+TILE_CONTAINMENT = 0.8
+
+
+class PyTorchBackend:
+    format = "pytorch"
+
+    def __init__(self, size=config.MODEL_SIZE, weights=None):
+        self.source_weights = weights or f"yolov8{size}.pt"
+        self.name = self.source_weights
+
+    def prepare(self):
+        # Returns what YOLO() should load, exporting it first if needed
+        return self.source_weights
+
+    def weights_file(self, model):
+        # ultralytics may have downloaded the weights somewhere other than the given name
+        return getattr(model, "ckpt_path", None) or self.source_weights
+
+
+class OnnxBackend(PyTorchBackend):
+    format = "onnx"
+
+    def __init__(self, size=config.MODEL_SIZE, int8=config.MODEL_INT8):
+        super().__init__(size)
+        self.size = size
+        self.int8 = int8
+        self.name = f"yolov8{size}{'-int8' if int8 else ''}.onnx"
+        self.path = os.path.join(config.MODEL_DIRECTORY, self.name)
+
+    def prepare(self):
+        if not os.path.exists(self.path):
+            self.export()
+        return self.path
+
+    def export(self):
+        from ultralytics import YOLO
+
+        os.makedirs(config.MODEL_DIRECTORY, exist_ok=True)
+        fp32_path = os.path.join(config.MODEL_DIRECTORY, f"yolov8{self.size}.onnx")
+        if not os.path.exists(fp32_path):
+            print(f"Exporting {self.source_weights} to ONNX, this only happens once")
+            exported = YOLO(self.source_weights).export(format="onnx", dynamic=True, simplify=True)
+            shutil.move(exported, fp32_path)
+        if self.int8:
+            from onnxruntime.quantization import QuantType, quantize_dynamic
+
+            print(f"Quantizing {fp32_path} to INT8")
+            quantize_dynamic(fp32_path, self.path, weight_type=QuantType.QUInt8)
+
+    def weights_file(self, model):
+        return self.path
+
+
+class OpenVinoBackend(PyTorchBackend):
+    format = "openvino"
+
+    def __init__(self, size=config.MODEL_SIZE, int8=config.MODEL_INT8):
+        super().__init__(size)
+        self.int8 = int8
+        # ultralytics recognises OpenVINO models by the _openvino_model suffix
+        self.name = f"yolov8{size}{'-int8' if int8 else ''}_openvino_model"
+        self.path = os.path.join(config.MODEL_DIRECTORY, self.name)
+
+    def prepare(self):
+        if not os.path.isdir(self.path):
+            from ultralytics import YOLO
+
+            print(f"Exporting {self.source_weights} to OpenVINO, this only happens once")
+            os.makedirs(config.MODEL_DIRECTORY, exist_ok=True)
+            exported = YOLO(self.source_weights).export(format="openvino", dynamic=True, int8=self.int8)
+            shutil.move(exported, self.path)
+        return self.path
+
+    def weights_file(self, model):
+        weights = glob.glob(os.path.join(self.path, "*.bin"))
+        return weights[0] if weights else self.path
+
+
+BACKENDS = {
+    "pytorch": PyTorchBackend,
+    "onnx": OnnxBackend,
+    "openvino": OpenVinoBackend,
+}
+
+
+def create_backend(name=config.DETECTION_BACKEND, size=config.MODEL_SIZE):
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown detection backend {name!r}, expected one of {', '.join(BACKENDS)}")
+    return BACKENDS[name](size)
+
+
+class Detector:
+    def __init__(self, backend=None):
+        self.backend = backend or create_backend()
+        self.model_name = self.backend.name
+        # Embeddings always come from the PyTorch weights, whatever runs detection
+        self.embedding_name = self.backend.source_weights
+        # Where the weights are expected before loading, so cached results can be found without the model
+        self.weights_path = self.backend.weights_file(None)
+        self.model = None
+        self.embedding_model = None
+        self.load_time = None
+        self._lock = threading.RLock()
+
+    def is_loaded(self):
+        return self.model is not None
+
+    def load(self):
+        with self._lock:
+            if self.model is None:
+                self._load_model()
+            return self.model
+
+    def reload(self, backend=None):
+        with self._lock:
+            if backend:
+                self.backend = backend
+                self.model_name = backend.name
+                self.embedding_name = backend.source_weights
+                self.weights_path = backend.weights_file(None)
+            self.model = None
+            self.embedding_model = None
+            self._load_model()
+            return self.model
+
+    def _load_model(self):
+        from ultralytics import YOLO
+        import numpy as np
+
+        start = time.perf_counter()
+        model = YOLO(self.backend.prepare(), task="detect")
+        # A first inference pass initialises the predictor and fuses layers
+        model(np.zeros((WARMUP_SIZE, WARMUP_SIZE, 3), dtype=np.uint8), verbose=False)
+        self.model = model
+        self.weights_path = self.backend.weights_file(model)
+        self.load_time = time.perf_counter() - start
+        print(f"Loaded {self.model_name} ({self.backend.format}) in {self.load_time:.2f}s")
+
+    def predict(self, source):
+        with self._lock:
+            model = self.load()
+            with metrics.span("detect.inference"):
+                results = model(source, verbose=False)
+        return results
+
+    def detect(self, source):
+        if config.TILED_INFERENCE:
+            sources = source if isinstance(source, list) else [source]
+            return [detection for detections in self.detect_batch(sources) for detection in detections]
+        detections = []
+        for result in self.predict(source):
+            detections += extract_detections(result)
+        return detections
+
+    def can_embed(self):
+        return self.backend.format == "pytorch" or config.EXPORTED_BACKEND_EMBEDDINGS
+
+    def embed(self, sources):
+        # Pooled backbone features, one vector per source. Exported models have no
+        # backbone hooks, so those backends embed with the PyTorch weights of the same size
+        if not self.can_embed():
+            raise RuntimeError(f"Embeddings are disabled for the {self.backend.format} backend, "
+                               f"set LF_EXPORTED_BACKEND_EMBEDDINGS=1 to enable them")
+        with self._lock:
+            model = self.load()
+            if self.backend.format != "pytorch":
+                if self.embedding_model is None:
+                    from ultralytics import YOLO
+
+                    self.embedding_model = YOLO(self.backend.source_weights)
+                model = self.embedding_model
+            vectors = model.embed(list(sources), verbose=False)
+        return [vector.detach().cpu().numpy().ravel() for vector in vectors]
+
+    def detect_batch(self, sources):
+        # One forward pass over the whole batch, one detection list per source
+        if config.TILED_INFERENCE:
+            return [[(label, confidence) for label, confidence, _ in boxes] for boxes in self.detect_tiled(sources)]
+        return [extract_detections(result) for result in self.predict(list(sources))]
+
+    def detect_tiled(self, sources):
+        # Every image is looked at whole and, when it is large, also as overlapping tiles so small
+        # items keep enough pixels. The crops of all images share one forward pass
+        import numpy as np
+
+        crops = []
+        origins = []
+        with metrics.span("detect.tiling"):
+            for index, source in enumerate(sources):
+                image = read_image(source)
+                height, width = image.shape[:2]
+                windows = [(0, 0, width, height)]
+                if max(width, height) >= config.TILE_MIN_SIDE:
+                    windows += tile_windows(width, height)
+                for x1, y1, x2, y2 in windows:
+                    crops.append(np.ascontiguousarray(image[y1:y2, x1:x2]))
+                    origins.append((index, x1, y1))
+        metrics.count("detect.tiles", len(crops) - len(sources))
+
+        boxes = [[] for _ in sources]
+        for (index, dx, dy), result in zip(origins, self.predict(crops)):
+            boxes[index] += [(label, confidence, (x1 + dx, y1 + dy, x2 + dx, y2 + dy))
+                             for label, confidence, (x1, y1, x2, y2) in extract_boxes(result)]
+        return [merge_boxes(image_boxes) for image_boxes in boxes]
+
+    def model_identity(self):
+        if not self.weights_path:
+            return None
+        fingerprint = weights_fingerprint(self.weights_path)
+        if fingerprint is None:
+            return None
+        if config.TILED_INFERENCE:
+            # Tiled results differ from whole image ones and with every tiling and merging setting,
+            # each combination is cached apart from the others
+            tiling = (f"{config.TILE_SIZE},{config.TILE_OVERLAP},{config.TILE_MIN_SIDE},{config.TILE_MAX_COUNT},"
+                      f"{TILE_NMS_IOU},{TILE_CONTAINMENT}")
+            return f"{self.model_name}@{fingerprint}/tiles{tiling}"
+        return f"{self.model_name}@{fingerprint}"
+
+
+def extract_detections(result):
+    return [(label, confidence) for label, confidence, _ in extract_boxes(result)]
+
+
+def extract_boxes(result, threshold=CONFIDENCE_THRESHOLD):
+    # (label, confidence, (x1, y1, x2, y2)) in pixels of the source image
+    boxes = []
+    names = result.names
+
+    for box in result.boxes:
+        label = names[int(box.cls)]
+        confidence = float(box.conf)
+        if confidence > threshold and label != "person":
+            boxes.append((label, confidence, tuple(float(value) for value in box.xyxy[0])))
+
+    return boxes
+
+
+def read_image(source):
+    if not isinstance(source, str):
+        return source
+    import cv2
+
+    image = cv2.imread(source)
+    if image is None:
+        raise ValueError(f"Could not read image {source}")
+    return image
+
+
+def tile_starts(length, tile_size, overlap):
+    # Evenly spread starts, neighbours overlap by at least the requested share of a tile
+    if length <= tile_size:
+        return [0]
+    count = math.ceil((length - tile_size) / (tile_size * (1 - overlap))) + 1
+    step = (length - tile_size) / (count - 1)
+    return [round(i * step) for i in range(count)]
+
+
+def tile_windows(width, height, tile_size=config.TILE_SIZE, overlap=config.TILE_OVERLAP,
+                 max_count=config.TILE_MAX_COUNT):
+    # (x1, y1, x2, y2) tiles covering the image. Very large images get larger tiles rather than
+    # more of them, so one image never costs more than max_count crops
+    while True:
+        xs = tile_starts(width, tile_size, overlap)
+        ys = tile_starts(height, tile_size, overlap)
+        if len(xs) * len(ys) <= max(1, max_count):
+            break
+        tile_size = int(tile_size * 1.25)
+    return [(x, y, min(x + tile_size, width), min(y + tile_size, height)) for y in ys for x in xs]
+
+
+def intersection_area(a, b):
+    x1, y1 = max(a[0], b[0]), max(a[1], b[1])
+    x2, y2 = min(a[2], b[2]), min(a[3], b[3])
+    return max(0.0, x2 - x1) * max(0.0, y2 - y1)
+
+
+def box_area(box):
+    return (box[2] - box[0]) * (box[3] - box[1])
+
+
+def iou(a, b):
+    intersection = intersection_area(a, b)
+    union = box_area(a) + box_area(b) - intersection
+    return intersection / union if union > 0 else 0.0
+
+
+def is_same_item(a, b):
+    if iou(a, b) >= TILE_NMS_IOU:
+        return True
+    smaller = min(box_area(a), box_area(b))
+    return smaller > 0 and intersection_area(a, b) / smaller >= TILE_CONTAINMENT
+
+
+def merge_boxes(boxes):
+    # Greedy non maximum suppression per label across the whole image and its tiles
+    kept = []
+    for box in sorted(boxes, key=lambda box: box[1], reverse=True):
+        if not any(label == box[0] and is_same_item(kept_box, box[2]) for label, _, kept_box in kept):
+            kept.append(box)
+    return kept
+
+
+_detector = None
+_detector_lock = threading.Lock()
+
+
+def get_detector():
+    global _detector
+    with _detector_lock:
+        if _detector is None:
+            _detector = Detector()
+        return _detector
+
+
+def cached_detections(image_path):
+    if not isinstance(image_path, str):
+        return get_detector().detect(image_path)
+    return cached_detections_batch([image_path])[0]
+
+
+def cached_detections_batch(image_paths):
+    # Images the cache can't answer all go through the model in a single forward pass
+    detector = get_detector()
+    if not config.DETECTION_CACHE_ENABLED:
+        return detector.detect_batch(image_paths)
+
+    # Look the images up before touching the model, the weights may not even be loaded yet
+    cache = get_cache()
+    with metrics.span("detect.hash"):
+        hashes = [file_sha256(image_path) for image_path in image_paths]
+    results = [None] * len(image_paths)
+    identity = detector.model_identity()
+    if identity:
+        with metrics.span("detect.cache_lookup"):
+            results = [cache.get(cache.make_key(image_sha256, identity, CONFIDENCE_THRESHOLD))
+                       for image_sha256 in hashes]
+    missing = [index for index, detections in enumerate(results) if detections is None]
+    metrics.count("detect.cache_hits", len(results) - len(missing))
+    metrics.count("detect.cache_misses", len(missing))
+    if not missing:
+        return results
+
+    detected = detector.detect_batch([image_paths[index] for index in missing])
+    identity = detector.model_identity()
+    for index, detections in zip(missing, detected):
+        results[index] = detections
+        if identity:
+            cache.put(cache.make_key(hashes[index], identity, CONFIDENCE_THRESHOLD), detections)
+    return results
+
+
+def identify_detections(lost_item):
+    with metrics.span("detect.total"):
+        if config.SERVICE_URL:
+            # A shared detection service runs the model, this process never loads it
+            import service_client
+
+            detections = service_client.detect(lost_item)
+        else:
+            detections = cached_detections(lost_item)
+    return detections[:2]
+
 
 def image_identification(lost_item):
-    tags = []
-    model = YOLO("yolov8m.pt")
-    results = model(lost_item)
-
-    for result in results:
-        boxes = result.boxes
-        names = result.names
-        
-        for box in boxes:
-            class_id = int(box.cls)
-            label = names[class_id]
-            confidence = float(box.conf)
-            if (confidence > 0.85):
-                tags += [label]
-    
-    tags = [tag for tag in tags if (tag != "person")]
-    
-    return tags[:2]
+    return [label for label, _ in identify_detections(lost_item)]
+
+def collect_image_paths(patterns, file_list=None):
+    paths = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            for root, _, files in os.walk(pattern):
+                paths += [os.path.join(root, name) for name in sorted(files)
+                          if name.lower().endswith(IMAGE_EXTENSIONS)]
+        elif glob.has_magic(pattern):
+            paths += [path for path in sorted(glob.glob(pattern, recursive=True))
+                      if path.lower().endswith(IMAGE_EXTENSIONS)]
+        else:
+            paths.append(pattern)
+
+    if file_list:
+        with open(file_list) as f:
+            paths += [line.strip() for line in f if line.strip()]
+
+    # Keep the first occurrence of every file
+    return list(dict.fromkeys(os.path.abspath(path) for path in paths))
+
+
+def load_image(path):
+    import cv2
+
+    image = cv2.imread(path)
+    if image is None:
+        return path, None, None
+    image_hash = duplicates.to_signed(duplicates.image_hash(path))
+    height, width = image.shape[:2]
+    scale = INGEST_MAX_SIDE / max(height, width)
+    # Tiled inference needs the full resolution, downscaling would lose the small items again
+    if scale < 1 and not config.TILED_INFERENCE:
+        image = cv2.resize(image, (int(width * scale), int(height * scale)), interpolation=cv2.INTER_AREA)
+    return path, image, image_hash
+
+
+def decode_images(paths, workers, window):
+    # Keep a bounded number of decodes in flight so memory stays flat on big runs
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        paths = iter(paths)
+        for path in paths:
+            pending.append(executor.submit(load_image, path))
+            if len(pending) >= window:
+                break
+        while pending:
+            yield pending.popleft().result()
+            for path in paths:
+                pending.append(executor.submit(load_image, path))
+                break
+
+
+def save_batch(conn, batch, detections, vectors, model_name, args, location, store_directory):
+    import embeddings
+
+    cursor = conn.cursor()
+    item_ids = []
+    for (path, _, image_hash), item_detections in zip(batch, detections):
+        save_path, _ = image_store.store_image(path, store_directory)
+        item_ids.append(database.insert_item(cursor, args.item_type, save_path, item_detections[:2], location,
+                                             args.area, args.building, args.floor, args.specific_location,
+                                             image_hash))
+
+    cursor.executemany("INSERT INTO ingested_files (source_path, item_id) VALUES (?, ?)",
+                       [(path, item_id) for (path, _, _), item_id in zip(batch, item_ids)])
+    embeddings.save_embeddings(cursor, zip(item_ids, vectors), model_name)
+    for item_id in item_ids:
+        matching.score_item(conn, item_id)
+    # Rows and resume markers for a batch are committed together
+    conn.commit()
+
+
+def ingest_batch(conn, detector, batch, args, location, store_directory):
+    images = [image for _, image, _ in batch]
+    detections = detector.detect_batch(images)
+    vectors = detector.embed(images) if detector.can_embed() else []
+    save_batch(conn, batch, detections, vectors, detector.embedding_name, args, location, store_directory)
+
+
+def bulk_ingest(args):
+    paths = collect_image_paths(args.paths, args.file_list)
+    store_directory = os.path.join(args.save_directory, "objects")
+    location = database.format_location(args.area, args.building, args.floor, args.specific_location)
+
+    conn = database.connect()
+    try:
+        database.migrate(conn)
+        done = {row[0] for row in conn.execute("SELECT source_path FROM ingested_files")}
+        remaining = [path for path in paths if path not in done]
+        print(f"{len(paths)} images found, {len(paths) - len(remaining)} already ingested, {len(remaining)} to go")
+        if not remaining:
+            return
+
+        detector = get_detector()
+        detector.load()
+
+        start = time.perf_counter()
+        processed = 0
+        failed = 0
+        batch = []
+        for path, image, image_hash in decode_images(remaining, args.workers, args.batch_size * 2):
+            if image is None:
+                print(f"Skipping unreadable image: {path}")
+                failed += 1
+                continue
+            batch.append((path, image, image_hash))
+            if len(batch) < args.batch_size:
+                continue
+
+            ingest_batch(conn, detector, batch, args, location, store_directory)
+            processed += len(batch)
+            batch = []
+            elapsed = time.perf_counter() - start
+            print(f"{processed}/{len(remaining)} images, {processed / elapsed:.1f} images/s")
+
+        if batch:
+            ingest_batch(conn, detector, batch, args, location, store_directory)
+            processed += len(batch)
+
+        elapsed = time.perf_counter() - start
+        print(f"Ingested {processed} images in {elapsed:.1f}s ({processed / elapsed:.1f} images/s), {failed} failed")
+    finally:
+        conn.close()
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Detect objects in images of lost and found items.")
+    parser.add_argument("paths", nargs="*", help="image files, directories or glob patterns")
+    parser.add_argument("--bulk", action="store_true", help="register every image as an item in the database")
+    parser.add_argument("--file-list", help="text file with one image path per line")
+    parser.add_argument("--type", dest="item_type", choices=["Lost", "Found"], default="Found")
+    parser.add_argument("--area", default="University")
+    parser.add_argument("--building", default="")
+    parser.add_argument("--floor", default="Not applicable")
+    parser.add_argument("--specific-location", default="Lost and found desk")
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--save-directory", default="saved_items")
+    args = parser.parse_args(argv)
+    if not args.paths and not args.file_list:
+        parser.error("no images given")
+    if args.bulk and not args.building:
+        parser.error("--building is required with --bulk")
+    return args
+
 
 if __name__ == "__main__":
-    file = sys.argv[1]
-    tags = image_identification(file)
-    print(tags)
\ No newline at end of file
+    args = parse_args(sys.argv[1:])
+    if args.bulk:
+        bulk_ingest(args)
+    else:
+        for file in collect_image_paths(args.paths, args.file_list):
+            tags = image_identification(file)
+            print(tags)
@@ -0,0 +1,156 @@
+import argparse
+import glob
+import os
+import shutil
+import sys
+import threading
+
+import config
+import database
+from detection_cache import file_sha256
+
+STORE_DIRECTORY = os.path.join("saved_items", "objects")
+FORMAT_EXTENSIONS = {"JPEG": ".jpg", "WEBP": ".webp", "PNG": ".png"}
+
+
+def object_directory(sha256, store_directory=STORE_DIRECTORY):
+    # Two levels of sharding keep every directory small
+    return os.path.join(store_directory, sha256[:2], sha256[2:4])
+
+
+def find_stored(sha256, store_directory=STORE_DIRECTORY):
+    matches = glob.glob(os.path.join(object_directory(sha256, store_directory), f"{sha256}.*"))
+    matches = [path for path in matches if not path.endswith(".tmp")]
+    return matches[0] if matches else None
+
+
+def recompress(source_path, target_path):
+    from PIL import Image, ImageOps
+
+    with Image.open(source_path) as image:
+        image = ImageOps.exif_transpose(image)
+        if image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        if config.IMAGE_MAX_SIDE:
+            image.thumbnail((config.IMAGE_MAX_SIDE, config.IMAGE_MAX_SIDE), Image.LANCZOS)
+        image.save(target_path, config.IMAGE_FORMAT, quality=config.IMAGE_QUALITY)
+
+
+def store_image(source_path, store_directory=STORE_DIRECTORY):
+    # Returns the stored path and whether this call created it; identical files are stored once
+    sha256 = file_sha256(source_path)
+    existing = find_stored(sha256, store_directory)
+    if existing:
+        return existing, False
+
+    directory = object_directory(sha256, store_directory)
+    os.makedirs(directory, exist_ok=True)
+    if config.IMAGE_RECOMPRESS:
+        extension = FORMAT_EXTENSIONS.get(config.IMAGE_FORMAT, ".jpg")
+    else:
+        extension = os.path.splitext(source_path)[1].lower()
+    path = os.path.join(directory, f"{sha256}{extension}")
+    # Unique per thread, the service stores images from several threads at once
+    temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+
+    try:
+        if config.IMAGE_RECOMPRESS:
+            recompress(source_path, temp_path)
+        else:
+            shutil.copy2(source_path, temp_path)
+        os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    return path, True
+
+
+def object_name(path):
+    # Stored objects are named <sha256><extension>, anything else is hashed
+    name = os.path.basename(path)
+    stem = os.path.splitext(name)[0]
+    if len(stem) == 64 and all(c in "0123456789abcdef" for c in stem):
+        return name
+    return file_sha256(path) + os.path.splitext(path)[1].lower()
+
+
+def import_object(source_path, name, store_directory=STORE_DIRECTORY):
+    # Places a file exported from another store under the same name, without recompressing it again
+    sha256 = os.path.splitext(name)[0]
+    existing = find_stored(sha256, store_directory)
+    if existing:
+        return existing, False
+
+    directory = object_directory(sha256, store_directory)
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, name)
+    temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        shutil.copyfile(source_path, temp_path)
+        os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    return path, True
+
+
+def is_referenced(conn, path):
+    if conn.execute("SELECT 1 FROM items WHERE image_path=? LIMIT 1", (path,)).fetchone():
+        return True
+    return database.has_table(conn, "items_archive") and conn.execute(
+        "SELECT 1 FROM items_archive WHERE image_path=? LIMIT 1", (path,)).fetchone() is not None
+
+
+def remove_if_unreferenced(conn, path):
+    if path and os.path.exists(path) and not is_referenced(conn, path):
+        os.remove(path)
+
+
+def migrate_images(store_directory=STORE_DIRECTORY, batch_size=200):
+    # Moves images saved under the old timestamped names into the store and rewrites image_path
+    conn = database.connect()
+    try:
+        database.migrate(conn)
+        prefix = os.path.join(store_directory, "")
+        rows = conn.execute("SELECT id, image_path FROM items WHERE image_path NOT LIKE ? || '%'",
+                            (prefix,)).fetchall()
+        before = after = 0
+        migrated = []
+        for item_id, image_path in rows:
+            if not os.path.exists(image_path):
+                print(f"Skipping item {item_id}, image not found: {image_path}")
+                continue
+            stored_path, created = store_image(image_path, store_directory)
+            before += os.path.getsize(image_path)
+            after += os.path.getsize(stored_path) if created else 0
+            migrated.append((stored_path, item_id, image_path))
+
+            if len(migrated) >= batch_size:
+                finish_migration_batch(conn, migrated)
+                migrated = []
+        if migrated:
+            finish_migration_batch(conn, migrated)
+        print(f"Migrated {len(rows)} images, {before / 2 ** 20:.1f} MB -> {after / 2 ** 20:.1f} MB")
+    finally:
+        conn.close()
+
+
+def finish_migration_batch(conn, migrated):
+    cursor = conn.cursor()
+    cursor.executemany("UPDATE items SET image_path=? WHERE id=?",
+                       [(stored_path, item_id) for stored_path, item_id, _ in migrated])
+    conn.commit()
+    # Old files are only deleted once no row points at them any more
+    for _, _, image_path in migrated:
+        remove_if_unreferenced(conn, image_path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Content addressed storage for item images.")
+    parser.add_argument("--migrate", action="store_true", help="move existing item images into the store")
+    parser.add_argument("--store-directory", default=STORE_DIRECTORY)
+    args = parser.parse_args(sys.argv[1:])
+    if args.migrate:
+        migrate_images(args.store_directory)
+    else:
+        parser.print_help()
@@ -0,0 +1,319 @@
+import os
+
+from PyQt5.QtCore import QAbstractListModel, QModelIndex, QRect, QSize, Qt, QThreadPool, pyqtSignal
+from PyQt5.QtGui import QFont, QFontMetrics, QPalette
+from PyQt5.QtWidgets import QStyle, QStyledItemDelegate
+
+import config
+import database
+import metrics
+from thumbnails import has_thumbnail, load_thumbnail
+from workers import QueryJob, ThumbnailJob, query_pool
+
+ItemIdRole = Qt.UserRole + 1
+ImagePathRole = Qt.UserRole + 2
+TagsRole = Qt.UserRole + 3
+LocationRole = Qt.UserRole + 4
+DateReportedRole = Qt.UserRole + 5
+ImageErrorRole = Qt.UserRole + 6
+
+
+def row_key(row):
+    # The (date_reported, id) key rows are listed by, newest first
+    return (row[4] or "", row[0])
+
+
+class ItemListModel(QAbstractListModel):
+    loaded = pyqtSignal()
+    failed = pyqtSignal(str)
+
+    def __init__(self, item_type, thumbnail_width, page_size=config.LIST_PAGE_SIZE, parent=None):
+        super().__init__(parent)
+        self.item_type = item_type
+        self.thumbnail_width = thumbnail_width
+        self.page_size = page_size
+        self.search_term = ""
+        self.tag = None
+        self.include_archived = False
+        self.rows = []
+        self.row_by_id = {}
+        self.has_more = True
+        self.fixed_ids = False
+        self.newest = None
+        # Search results are paged by offset, rows prepended by a refresh don't count towards it
+        self.offset = 0
+        self.query_job = None
+        self.generation = 0
+        self.pending_thumbnails = set()
+        self.failed_thumbnails = set()
+
+    def is_loading(self):
+        return self.query_job is not None
+
+    def set_search(self, search_term, tag=None, include_archived=False):
+        query = (search_term, tag, include_archived)
+        if not self.fixed_ids and self.newest is not None and query == (self.search_term, self.tag, self.include_archived):
+            # Same query as the one shown, only rows reported since then are fetched
+            self.refresh()
+            return
+        self.cancel_query()
+        self.beginResetModel()
+        self.search_term = search_term
+        self.tag = tag
+        self.include_archived = include_archived
+        self.rows = []
+        self.row_by_id = {}
+        self.has_more = True
+        self.fixed_ids = False
+        self.newest = None
+        self.offset = 0
+        self.endResetModel()
+        self.fetch_page()
+
+    def set_ids(self, item_ids):
+        # Show a fixed list of items, e.g. visually similar ones, in the given order
+        conn = database.connect()
+        try:
+            rows = database.fetch_items_by_ids(conn, item_ids)
+        finally:
+            conn.close()
+
+        self.cancel_query()
+        self.beginResetModel()
+        self.search_term = ""
+        self.tag = None
+        self.include_archived = False
+        self.rows = rows
+        self.row_by_id = {row[0]: index for index, row in enumerate(rows)}
+        self.has_more = False
+        self.fixed_ids = True
+        self.newest = None
+        self.endResetModel()
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.rows)
+
+    def canFetchMore(self, parent=QModelIndex()):
+        return not parent.isValid() and self.has_more and not self.is_loading()
+
+    def fetchMore(self, parent=QModelIndex()):
+        if not parent.isValid():
+            self.fetch_page()
+
+    def cancel_query(self):
+        # Results of a query that is no longer wanted are dropped when they arrive
+        if self.query_job:
+            self.query_job.cancel()
+            self.query_job = None
+        self.generation += 1
+
+    def start_query(self, on_finished, query, *args):
+        self.cancel_query()
+        generation = self.generation
+        job = QueryJob(query, *args)
+        job.signals.finished.connect(lambda rows: self.on_query_finished(generation, on_finished, rows))
+        job.signals.failed.connect(lambda error: self.on_query_failed(generation, error))
+        self.query_job = job
+        query_pool().start(job)
+
+    def on_query_finished(self, generation, on_finished, rows):
+        if generation != self.generation:
+            return
+        self.query_job = None
+        on_finished(rows)
+        self.loaded.emit()
+
+    def on_query_failed(self, generation, error):
+        if generation != self.generation:
+            return
+        self.query_job = None
+        self.has_more = False
+        self.failed.emit(error)
+
+    def fetch_page(self):
+        if self.is_loading():
+            return
+        if self.search_term:
+            self.start_query(self.append_rows, query_page, self.item_type, self.search_term, self.tag,
+                             self.include_archived, None, self.offset, self.page_size)
+        else:
+            after = row_key(self.rows[-1]) if self.rows else None
+            self.start_query(self.append_rows, query_page, self.item_type, "", self.tag,
+                             self.include_archived, after, 0, self.page_size)
+
+    def refresh(self):
+        if self.is_loading():
+            return
+        self.start_query(self.prepend_rows, query_newer, self.item_type, self.newest, self.search_term, self.tag,
+                         config.REFRESH_MAX_NEW_ROWS)
+
+    def append_rows(self, rows):
+        self.has_more = len(rows) == self.page_size
+        self.offset += len(rows)
+        rows = [row for row in rows if row[0] not in self.row_by_id]
+        self.update_newest(rows)
+        if not rows:
+            return
+        with metrics.span("browse.insert_rows"):
+            first = len(self.rows)
+            self.beginInsertRows(QModelIndex(), first, first + len(rows) - 1)
+            for offset, row in enumerate(rows):
+                self.row_by_id[row[0]] = first + offset
+            self.rows += rows
+            self.endInsertRows()
+
+    def prepend_rows(self, rows):
+        rows = [row for row in rows if row[0] not in self.row_by_id]
+        if len(rows) >= config.REFRESH_MAX_NEW_ROWS:
+            # Too much has changed to patch in place, start over from the first page
+            self.newest = None
+            self.set_search(self.search_term, self.tag, self.include_archived)
+            return
+        self.update_newest(rows)
+        if not rows:
+            return
+        with metrics.span("browse.insert_rows"):
+            self.beginInsertRows(QModelIndex(), 0, len(rows) - 1)
+            self.rows = rows + self.rows
+            self.row_by_id = {row[0]: index for index, row in enumerate(self.rows)}
+            self.endInsertRows()
+
+    def remove_item(self, item_id):
+        # E.g. a report marked resolved, which is about to be archived
+        row = self.row_by_id.get(item_id)
+        if row is None:
+            return
+        self.beginRemoveRows(QModelIndex(), row, row)
+        del self.rows[row]
+        self.row_by_id = {row[0]: index for index, row in enumerate(self.rows)}
+        if self.search_term:
+            self.offset -= 1
+        self.endRemoveRows()
+
+    def update_newest(self, rows):
+        for row in rows:
+            if self.newest is None or row_key(row) > self.newest:
+                self.newest = row_key(row)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid() or index.row() >= len(self.rows):
+            return None
+        item_id, image_path, tags, location, date_reported = self.rows[index.row()]
+
+        if role == Qt.DisplayRole:
+            return f"{tags}\n{location}\n{date_reported}"
+        if role == Qt.DecorationRole:
+            # Only rows the view actually paints get here, so images load for visible rows only
+            return self.thumbnail(item_id, image_path)
+        if role == ItemIdRole:
+            return item_id
+        if role == ImagePathRole:
+            return image_path
+        if role == TagsRole:
+            return tags
+        if role == LocationRole:
+            return location
+        if role == DateReportedRole:
+            return date_reported
+        if role == ImageErrorRole:
+            if not os.path.exists(image_path):
+                return "Image not found"
+            if item_id in self.failed_thumbnails:
+                return "Invalid image file"
+            return None
+        return None
+
+    def thumbnail(self, item_id, image_path):
+        if not has_thumbnail(item_id, self.thumbnail_width):
+            # Decoding the original is slow, create the thumbnail off the GUI thread
+            if item_id not in self.pending_thumbnails and item_id not in self.failed_thumbnails \
+                    and os.path.exists(image_path):
+                self.pending_thumbnails.add(item_id)
+                job = ThumbnailJob([(item_id, image_path)], self.thumbnail_width)
+                job.signals.finished.connect(self.on_thumbnails_ready)
+                QThreadPool.globalInstance().start(job)
+            return None
+        return load_thumbnail(item_id, image_path, self.thumbnail_width)
+
+    def on_thumbnails_ready(self, created, failed):
+        self.failed_thumbnails.update(failed)
+        for item_id in created + failed:
+            self.pending_thumbnails.discard(item_id)
+            row = self.row_by_id.get(item_id)
+            if row is not None:
+                index = self.index(row)
+                self.dataChanged.emit(index, index, [Qt.DecorationRole])
+
+
+def query_page(conn, item_type, search_term, tag, include_archived, after, offset, limit):
+    # Runs on a query pool thread
+    with metrics.span("browse.query"):
+        if search_term:
+            return database.search_items_page(conn, item_type, search_term, offset, limit, tag, include_archived)
+        return database.fetch_items_page(conn, item_type, after, limit, tag, include_archived)
+
+
+def query_newer(conn, item_type, newest, search_term, tag, limit):
+    with metrics.span("browse.refresh"):
+        return database.fetch_items_newer(conn, item_type, newest, search_term, tag, limit)
+
+
+class ItemDelegate(QStyledItemDelegate):
+    def __init__(self, thumbnail_width, parent=None):
+        super().__init__(parent)
+        self.thumbnail_width = thumbnail_width
+        self.thumbnail_height = int(thumbnail_width * 0.75)
+        self.margin = 10
+
+    def sizeHint(self, option, index):
+        line_height = QFontMetrics(option.font).height()
+        return QSize(self.thumbnail_width + 2 * self.margin,
+                     self.thumbnail_height + 3 * line_height + 4 * self.margin)
+
+    def paint(self, painter, option, index):
+        with metrics.span("browse.paint_row"):
+            self.paint_item(painter, option, index)
+
+    def paint_item(self, painter, option, index):
+        painter.save()
+        if option.state & QStyle.State_Selected:
+            painter.fillRect(option.rect, option.palette.alternateBase())
+
+        rect = option.rect.adjusted(self.margin, self.margin, -self.margin, -self.margin)
+        image_rect = QRect(rect.left(), rect.top(), rect.width(), self.thumbnail_height)
+        pixmap = index.data(Qt.DecorationRole)
+        if pixmap is not None:
+            size = pixmap.size().scaled(image_rect.size(), Qt.KeepAspectRatio)
+            target = QRect(0, 0, size.width(), size.height())
+            target.moveCenter(image_rect.center())
+            painter.drawPixmap(target, pixmap)
+        else:
+            text = index.data(ImageErrorRole) or "Loading image..."
+            painter.setPen(option.palette.color(QPalette.Mid))
+            painter.drawText(image_rect, Qt.AlignCenter, text)
+
+        line_height = QFontMetrics(option.font).height()
+        top = image_rect.bottom() + self.margin
+        lines = [("Tags:", index.data(TagsRole)),
+                 ("Location:", index.data(LocationRole))]
+        for label, value in lines:
+            if value:
+                self.draw_field(painter, option, QRect(rect.left(), top, rect.width(), line_height), label, value)
+            top += line_height + self.margin // 2
+
+        painter.setPen(option.palette.color(QPalette.Mid))
+        date_rect = QRect(rect.left(), top, rect.width(), line_height)
+        painter.drawText(date_rect, Qt.AlignLeft | Qt.AlignVCenter, f"Reported on: {index.data(DateReportedRole)}")
+        painter.restore()
+
+    def draw_field(self, painter, option, rect, label, value):
+        bold_font = QFont(option.font)
+        bold_font.setBold(True)
+        painter.setPen(option.palette.color(QPalette.Text))
+        painter.setFont(bold_font)
+        label_width = QFontMetrics(bold_font).horizontalAdvance(label + " ")
+        painter.drawText(rect, Qt.AlignLeft | Qt.AlignVCenter, label)
+        painter.setFont(option.font)
+        value_rect = rect.adjusted(label_width, 0, 0, 0)
+        value = QFontMetrics(option.font).elidedText(value, Qt.ElideRight, value_rect.width())
+        painter.drawText(value_rect, Qt.AlignLeft | Qt.AlignVCenter, value)
@@ -1,23 +1,45 @@
+import time
+STARTUP_BEGIN = time.perf_counter()
+
 import sys
 import os
+import json
 import sqlite3
-import shutil
-from pathlib import Path
-from datetime import datetime
 from PyQt5.QtWidgets import (QApplication, QMainWindow, QWidget, QLabel,
                              QPushButton, QVBoxLayout, QHBoxLayout, QFileDialog,
                              QLineEdit,
                              QMessageBox, QTabWidget, QGridLayout,
                              QStackedLayout, QRadioButton, QScrollArea,
-                             QDesktopWidget, QComboBox)
+                             QDesktopWidget, QComboBox, QListView, QListWidget, QMenu,
+                             QTableWidget, QTableWidgetItem, QHeaderView, QCheckBox)
 from PyQt5.QtGui import QPixmap, QFont
-from PyQt5.QtCore import Qt
-from image_detection import image_identification
-
-# Configure database path
-DATABASE_DIR = Path.home() / "lost-and-found"
-DATABASE_DIR.mkdir(exist_ok=True)
-DATABASE_FILE = str(DATABASE_DIR / "reported_items.db")
+from PyQt5.QtCore import Qt, QThreadPool, QTimer
+from workers import (DetectionJob, EmbeddingJob, ModelLoadJob, QueryJob, RetentionJob, SimilarityJob,
+                     ThumbnailBackfillJob, ThumbnailJob, detection_pool, query_pool)
+from thumbnails import setup_thumbnail_cache
+from item_list import ItemDelegate, ItemIdRole, ItemListModel
+import config
+import database
+import matching
+import duplicates
+import image_store
+import metrics
+
+startup_times = {}
+
+
+def mark_startup(stage):
+    startup_times[stage] = round(time.perf_counter() - STARTUP_BEGIN, 3)
+
+
+def write_startup_report():
+    # One JSON line per start so regressions show up over time
+    print("Startup times (s): " + ", ".join(f"{stage} {seconds}" for stage, seconds in startup_times.items()))
+    try:
+        with open(database.DATABASE_DIR / "startup_times.jsonl", "a") as f:
+            f.write(json.dumps(startup_times) + "\n")
+    except OSError as e:
+        print(f"Could not write startup report: {e}")
 
 class MainWindow(QMainWindow):
     def __init__(self):
@@ -61,6 +83,8 @@ class MainWindow(QMainWindow):
             }
         """)
         self.create_database()
+        mark_startup("database")
+        setup_thumbnail_cache()
 
         self.central_widget = QWidget()
         self.setCentralWidget(self.central_widget)
@@ -70,10 +94,43 @@ class MainWindow(QMainWindow):
         self.found_tab = ImageTab("Found")
         self.tab_widget.addTab(self.lost_tab, "Lost Items")
         self.tab_widget.addTab(self.found_tab, "Found Items")
+        if metrics.enabled:
+            self.tab_widget.addTab(DiagnosticsTab(), "Diagnostics")
 
         main_layout = QVBoxLayout(self.central_widget)
         main_layout.addWidget(self.tab_widget)
 
+        self.statusBar().showMessage("Loading detection model...")
+        self.model_load_job = None
+
+    def start_background_work(self):
+        mark_startup("window_shown")
+        # The detection model is imported and loaded only once the window is up,
+        # detection jobs queue behind it on the same pool
+        self.model_load_job = ModelLoadJob()
+        self.model_load_job.signals.ready.connect(self.on_model_ready)
+        self.model_load_job.signals.failed.connect(self.on_model_failed)
+        detection_pool().start(self.model_load_job)
+
+        # Create thumbnails for items reported before thumbnails existed
+        QThreadPool.globalInstance().start(ThumbnailBackfillJob(self.lost_tab.image_display_width))
+
+        # Move old and resolved reports out of the everyday tables
+        if config.RETENTION_AUTO:
+            QThreadPool.globalInstance().start(RetentionJob())
+
+    def on_model_ready(self, load_time):
+        mark_startup("model_ready")
+        self.statusBar().showMessage(f"Detection model ready (loaded in {load_time:.1f}s)", 10000)
+        for tab in (self.lost_tab, self.found_tab):
+            tab.set_model_ready(True)
+        write_startup_report()
+
+    def on_model_failed(self, error):
+        mark_startup("model_failed")
+        self.statusBar().showMessage(f"Detection model failed to load: {error}")
+        write_startup_report()
+
     def set_window_size_to_screen(self):
         screen = QDesktopWidget().screenGeometry()
         self.setGeometry(100, 100, int(screen.width() * 0.8), int(screen.height() * 0.8))
@@ -81,23 +138,8 @@ class MainWindow(QMainWindow):
     def create_database(self):
         conn = None
         try:
-            conn = sqlite3.connect(DATABASE_FILE)
-            cursor = conn.cursor()
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS items (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    item_type TEXT NOT NULL,
-                    image_path TEXT NOT NULL,
-                    tags TEXT,
-                    location TEXT,
-                    area TEXT,
-                    building TEXT,
-                    floor TEXT,
-                    specific_location TEXT,
-                    date_reported TEXT DEFAULT CURRENT_TIMESTAMP
-                )
-            """)
-            conn.commit()
+            conn = database.connect()
+            database.migrate(conn)
         except sqlite3.Error as e:
             QMessageBox.critical(self, "Database Error", f"Could not initialize database: {str(e)}")
         finally:
@@ -108,8 +150,7 @@ class ImageTab(QWidget):
     def __init__(self, item_type, save_directory="saved_items"):
         super().__init__()
         self.item_type = item_type
-        self.save_directory = os.path.join(save_directory, item_type.lower())
-        os.makedirs(self.save_directory, exist_ok=True)
+        self.store_directory = os.path.join(save_directory, "objects")
 
         # Main scroll area for the entire tab
         self.main_scroll = QScrollArea()
@@ -130,9 +171,11 @@ class ImageTab(QWidget):
         self.option_layout.setSpacing(20)
         self.upload_new_radio = QRadioButton(f"Report New {item_type} Item")
         self.view_existing_radio = QRadioButton(f"View Reported {item_type} Items")
+        self.view_matches_radio = QRadioButton("Possible Matches")
         self.upload_new_radio.setChecked(True)
         self.option_layout.addWidget(self.upload_new_radio)
         self.option_layout.addWidget(self.view_existing_radio)
+        self.option_layout.addWidget(self.view_matches_radio)
         self.option_layout.addStretch()
         self.main_layout.addLayout(self.option_layout)
 
@@ -200,6 +243,11 @@ class ImageTab(QWidget):
         self.update_building_options()
         self.update_floor_options()
 
+        # Detected tags, filled in by the background detection job
+        self.tags_label = QLabel("Detected tags: -")
+        self.tags_label.setWordWrap(True)
+        self.upload_layout.addWidget(self.tags_label, 8, 0, 1, 2)
+
         # Buttons
         self.bottom_buttons_layout = QHBoxLayout()
         self.submit_button = QPushButton("Submit Report")
@@ -227,29 +275,73 @@ class ImageTab(QWidget):
         self.search_layout = QHBoxLayout()
         self.search_input = QLineEdit()
         self.search_input.setPlaceholderText("Search by tags or location...")
+        # Searches as you type, once typing pauses
+        self.search_timer = QTimer(self)
+        self.search_timer.setSingleShot(True)
+        self.search_timer.setInterval(config.SEARCH_DEBOUNCE_MS)
+        self.search_timer.timeout.connect(self.search_items)
+        self.search_input.textEdited.connect(self.search_timer.start)
+        self.search_input.returnPressed.connect(self.search_items)
+        self.facets_job = None
         self.search_button = QPushButton("Search")
-        self.search_button.clicked.connect(self.show_existing_items)
+        self.search_button.clicked.connect(self.search_items)
         self.clear_search_button = QPushButton("Clear")
         self.clear_search_button.clicked.connect(self.clear_search)
+        self.tag_filter_combo = QComboBox()
+        self.tag_filter_combo.addItem("All tags", None)
+        self.tag_filter_combo.activated.connect(self.search_items)
+        self.include_archived_checkbox = QCheckBox("Include archived")
+        self.include_archived_checkbox.toggled.connect(self.search_items)
         
         self.search_layout.addWidget(self.search_input)
+        self.search_layout.addWidget(self.tag_filter_combo)
+        self.search_layout.addWidget(self.include_archived_checkbox)
         self.search_layout.addWidget(self.search_button)
         self.search_layout.addWidget(self.clear_search_button)
         self.existing_layout.addLayout(self.search_layout)
 
-        self.existing_scroll_area = QScrollArea()
-        self.existing_scroll_area.setWidgetResizable(True)
-        self.existing_scroll_content = QWidget()
-        self.existing_list_layout = QVBoxLayout(self.existing_scroll_content)
-        self.existing_list_layout.setContentsMargins(5, 5, 5, 5)
-        self.existing_list_layout.setSpacing(20)
-        self.existing_scroll_area.setWidget(self.existing_scroll_content)
-        self.existing_layout.addWidget(self.existing_scroll_area)
+        self.no_items_label = QLabel(f"No reported {item_type.lower()} items found.")
+        self.no_items_label.setAlignment(Qt.AlignCenter)
+        self.no_items_label.hide()
+        self.existing_layout.addWidget(self.no_items_label)
+
+        # Rows are painted by a delegate and paged in from the database as the view scrolls
+        self.item_model = ItemListModel(item_type, self.image_display_width)
+        self.item_model.loaded.connect(self.on_items_loaded)
+        self.item_model.failed.connect(self.on_items_failed)
+        self.item_view = QListView()
+        self.item_view.setModel(self.item_model)
+        self.item_view.setItemDelegate(ItemDelegate(self.image_display_width, self.item_view))
+        self.item_view.setUniformItemSizes(True)
+        self.item_view.setVerticalScrollMode(QListView.ScrollPerPixel)
+        self.item_view.setMinimumHeight(self.image_display_height * 2)
+        self.item_view.setContextMenuPolicy(Qt.CustomContextMenu)
+        self.item_view.customContextMenuRequested.connect(self.show_item_menu)
+        self.existing_layout.addWidget(self.item_view)
         
         self.stacked_layout.addWidget(self.existing_widget)
 
+        # Matches against the opposite item type
+        self.matches_widget = QWidget()
+        self.matches_layout = QVBoxLayout(self.matches_widget)
+        self.matches_layout.setContentsMargins(10, 10, 10, 10)
+        self.matches_layout.setSpacing(15)
+
+        other_type = matching.OPPOSITE_TYPE[item_type]
+        self.matches_label = QLabel(f"{item_type} Items Possibly Matching a {other_type} Report:")
+        self.matches_label.setFont(QFont("Arial", 12, QFont.Bold))
+        self.matches_layout.addWidget(self.matches_label)
+
+        self.matches_list = QListWidget()
+        self.matches_list.setWordWrap(True)
+        self.matches_list.setMinimumHeight(self.image_display_height * 2)
+        self.matches_layout.addWidget(self.matches_list)
+
+        self.stacked_layout.addWidget(self.matches_widget)
+
         self.upload_new_radio.toggled.connect(lambda checked: self.stacked_layout.setCurrentIndex(0) if checked else None)
         self.view_existing_radio.toggled.connect(self.show_existing_items)
+        self.view_matches_radio.toggled.connect(lambda checked: self.show_matches() if checked else None)
 
         # Set the main scroll as the layout
         layout = QVBoxLayout(self)
@@ -258,7 +350,16 @@ class ImageTab(QWidget):
 
         self.current_image_path = None
         self.displayed_image = None
-        self.tags = []
+        self.detections = []
+        self.image_hash = None
+        # (path, created) of the picked image in the store, None while the detection job stores it
+        self.stored_image = None
+        self.store_error = None
+        self.detection_job = None
+        self.detection_job_id = 0
+        self.pending_submission = None
+        self.similarity_job = None
+        self.model_ready = False
 
     def update_building_options(self):
         self.building_combo.clear()
@@ -311,21 +412,25 @@ class ImageTab(QWidget):
         self.current_image_path = file_path
         try:
             # Load the image directly as pixmap for better performance
-            pixmap = QPixmap(file_path)
+            with metrics.span("upload.decode"):
+                pixmap = QPixmap(file_path)
             if pixmap.isNull():
                 raise ValueError("Invalid image file")
                 
             # Scale the pixmap while maintaining aspect ratio
-            scaled_pixmap = pixmap.scaled(
-                self.image_display_width, 
-                self.image_display_height,
-                Qt.KeepAspectRatio,
-                Qt.SmoothTransformation
-            )
-            self.image_label.setPixmap(scaled_pixmap)
+            with metrics.span("upload.scale"):
+                scaled_pixmap = pixmap.scaled(
+                    self.image_display_width, 
+                    self.image_display_height,
+                    Qt.KeepAspectRatio,
+                    Qt.SmoothTransformation
+                )
+                self.image_label.setPixmap(scaled_pixmap)
             self.image_label.setStyleSheet("border: 2px solid #ccc; background-color: transparent;")
+            self.start_detection(file_path)
         except Exception as e:
             QMessageBox.warning(self, "Error", f"Could not load image: {str(e)}")
+            self.cancel_detection()
             self.current_image_path = None
             self.image_label.setText("Failed to load image")
             self.image_label.setStyleSheet("""
@@ -335,6 +440,102 @@ class ImageTab(QWidget):
                 font-style: italic;
             """)
 
+    def start_detection(self, image_path):
+        # Start detecting as soon as an image is picked so tags are usually ready by submit time
+        self.cancel_detection()
+        self.detection_job_id += 1
+        self.detections = None
+        if self.model_ready:
+            self.tags_label.setText("Detected tags: detecting...")
+        else:
+            self.tags_label.setText("Detected tags: waiting for the detection model to load...")
+
+        self.detection_job = DetectionJob(self.detection_job_id, image_path, self.store_directory)
+        self.detection_job.signals.finished.connect(self.on_detection_finished)
+        self.detection_job.signals.failed.connect(self.on_detection_failed)
+        self.detection_job.signals.stored.connect(self.on_image_stored)
+        self.detection_job.signals.store_failed.connect(self.on_image_store_failed)
+        detection_pool().start(self.detection_job)
+
+    def set_model_ready(self, ready):
+        self.model_ready = ready
+        if ready and self.detection_job is not None and self.detections is None:
+            self.tags_label.setText("Detected tags: detecting...")
+
+    def cancel_detection(self):
+        if self.detection_job:
+            self.detection_job.cancel()
+            self.detection_job = None
+        self.detections = []
+        self.image_hash = None
+        self.discard_stored_image(self.stored_image)
+        self.stored_image = None
+        self.store_error = None
+
+    def discard_stored_image(self, stored_image):
+        # A stored image that was never submitted is removed again, unless a report uses it
+        if not stored_image or not stored_image[1]:
+            return
+        conn = None
+        try:
+            conn = database.connect()
+            image_store.remove_if_unreferenced(conn, stored_image[0])
+        except (OSError, sqlite3.Error) as e:
+            print(f"Could not remove unused image {stored_image[0]}: {e}")
+        finally:
+            if conn:
+                conn.close()
+
+    def is_ready_to_save(self):
+        return self.detections is not None and (self.stored_image is not None or self.store_error is not None)
+
+    def on_detection_finished(self, job_id, detections, image_hash):
+        if job_id != self.detection_job_id or self.detection_job is None:
+            return
+        self.detections = detections
+        self.image_hash = image_hash
+        tags = [tag for tag, _ in detections]
+        self.tags_label.setText(f"Detected tags: {', '.join(tags) if tags else 'none'}")
+
+        if self.pending_submission and self.is_ready_to_save():
+            self.finish_pending_submission()
+
+    def on_detection_failed(self, job_id, error):
+        if job_id != self.detection_job_id or self.detection_job is None:
+            return
+        self.detections = []
+        self.tags_label.setText("Detected tags: detection failed")
+        QMessageBox.warning(self, "Warning", f"Object detection failed, the item will be saved without tags:\n\n{error}")
+
+        if self.pending_submission and self.is_ready_to_save():
+            self.finish_pending_submission()
+
+    def on_image_stored(self, job_id, save_path, created):
+        if job_id != self.detection_job_id or self.detection_job is None:
+            # The image was picked again or the form reset while it was being stored
+            self.discard_stored_image((save_path, created))
+            return
+        self.detection_job = None
+        self.stored_image = (save_path, created)
+        if self.pending_submission and self.is_ready_to_save():
+            self.finish_pending_submission()
+
+    def on_image_store_failed(self, job_id, error):
+        if job_id != self.detection_job_id or self.detection_job is None:
+            return
+        self.detection_job = None
+        self.store_error = error
+        if self.pending_submission and self.is_ready_to_save():
+            self.finish_pending_submission()
+
+    def finish_pending_submission(self):
+        location, area, building, floor, specific_location = self.pending_submission
+        self.pending_submission = None
+        self.submit_button.setEnabled(True)
+        self.upload_button.setEnabled(True)
+        self.submit_button.setText("Submit Report")
+        self.save_item(location, area, building, floor, specific_location, self.detections)
+
     def submit_data(self):
         if not self.current_image_path:
             QMessageBox.warning(self, "Warning", "Please select an image to report.")
@@ -344,8 +545,7 @@ class ImageTab(QWidget):
         building = self.building_combo.currentText().strip()
         floor = self.floor_combo.currentText().strip()
         specific_location = self.specific_location_input.text().strip()
-        tags = image_identification(self.current_image_path)
-        
+
         if not area or not building or not specific_location:
             QMessageBox.warning(self, "Warning", "Please provide complete location information.")
             return
@@ -354,10 +554,7 @@ class ImageTab(QWidget):
             QMessageBox.warning(self, "Warning", "Please select a floor for the mess.")
             return
             
-        location = f"{area}, {building}"
-        if floor != "Not applicable":
-            location += f", {floor}"
-        location += f", {specific_location}"
+        location = database.format_location(area, building, floor, specific_location)
 
         reply = QMessageBox.question(
             self, 
@@ -368,47 +565,90 @@ class ImageTab(QWidget):
         
         if reply == QMessageBox.No:
             return
-            
-        # Generate unique filename using timestamp
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        file_ext = os.path.splitext(self.current_image_path)[1]
-        new_filename = f"{self.item_type.lower()}_{timestamp}{file_ext}"
-        save_path = os.path.join(self.save_directory, new_filename)
 
-        conn = None
+        if not self.is_ready_to_save():
+            # Detection is still running, save once its tags arrive and the image is stored
+            self.pending_submission = (location, area, building, floor, specific_location)
+            self.submit_button.setEnabled(False)
+            self.upload_button.setEnabled(False)
+            self.submit_button.setText("Detecting objects...")
+            return
+
+        self.save_item(location, area, building, floor, specific_location, self.detections)
+
+    def confirm_not_duplicate(self):
+        if self.image_hash is None:
+            return True
         try:
-            # Create directory if it doesn't exist
-            os.makedirs(self.save_directory, exist_ok=True)
-            
-            # Copy the image to our storage directory
-            shutil.copy2(self.current_image_path, save_path)
+            with metrics.span("submit.duplicate_check"):
+                matches = duplicates.find_near_duplicates(self.image_hash, self.item_type)
+        except sqlite3.Error as e:
+            print(f"Could not check for duplicates: {e}")
+            return True
+        if not matches:
+            return True
+
+        listed = ", ".join(f"#{item_id}" for item_id, _ in matches[:5])
+        reply = QMessageBox.question(
+            self,
+            "Possible Duplicate",
+            f"This image looks almost identical to already reported {self.item_type.lower()} item(s) {listed}.\n\n"
+            "Submit it anyway?",
+            QMessageBox.Yes | QMessageBox.No
+        )
+        return reply == QMessageBox.Yes
+
+    def save_item(self, location, area, building, floor, specific_location, detections):
+        if not self.confirm_not_duplicate():
+            return
 
-            conn = sqlite3.connect(DATABASE_FILE)
+        if self.store_error is not None:
+            QMessageBox.critical(
+                self, 
+                "Error", 
+                f"Failed to save item:\n\n{self.store_error}\n\nPlease try again."
+            )
+            return
+
+        # The detection job already stored the image under its content hash
+        save_path = self.stored_image[0]
+        conn = None
+        try:
+            conn = database.connect()
             cursor = conn.cursor()
-            cursor.execute("""
-                INSERT INTO items (item_type, image_path, tags, location, area, building, floor, specific_location)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-            """, (self.item_type, save_path, ",".join(tags), location, area, building, floor, specific_location))
-            conn.commit()
+            image_hash = duplicates.to_signed(self.image_hash) if self.image_hash is not None else None
+            with metrics.span("submit.db_insert"):
+                item_id = database.insert_item(cursor, self.item_type, save_path, detections, location, area, building, floor, specific_location,
+                                               image_hash)
+            with metrics.span("submit.match"):
+                matches = matching.score_item(conn, item_id)
+            with metrics.span("submit.commit"):
+                conn.commit()
+            # The report owns the stored image now, resetting the form must not remove it
+            self.stored_image = None
+            metrics.count("submit.items")
+            QThreadPool.globalInstance().start(ThumbnailJob([(item_id, save_path)], self.image_display_width))
+            detection_pool().start(EmbeddingJob(item_id, self.item_type, save_path))
+            if self.image_hash is not None:
+                duplicates.add_to_tree(item_id, self.item_type, self.image_hash)
 
             QMessageBox.information(
                 self, 
                 "Success", 
                 f"{self.item_type} item reported successfully.\n\nLocation: {location}"
+                f"\n\nPossible matches found: {len(matches)}"
             )
             self.reset_form()
         except Exception as e:
+            metrics.count("submit.errors")
             QMessageBox.critical(
                 self, 
                 "Error", 
                 f"Failed to save item:\n\n{str(e)}\n\nPlease try again."
             )
-            # Clean up if we copied the file but failed to save to DB
-            if os.path.exists(save_path):
-                try:
-                    os.remove(save_path)
-                except:
-                    pass
+            # The stored image stays for another try, it is removed once the form is reset
+            if conn:
+                conn.rollback()
         finally:
             if conn:
                 conn.close()
@@ -424,6 +664,12 @@ class ImageTab(QWidget):
         """)
         
         self.current_image_path = None
+        self.cancel_detection()
+        self.pending_submission = None
+        self.submit_button.setEnabled(True)
+        self.upload_button.setEnabled(True)
+        self.submit_button.setText("Submit Report")
+        self.tags_label.setText("Detected tags: -")
         self.area_combo.setCurrentIndex(0)
         self.update_building_options()
         self.specific_location_input.clear()
@@ -434,120 +680,201 @@ class ImageTab(QWidget):
 
     def clear_search(self):
         self.search_input.clear()
-        self.show_existing_items()
+        self.tag_filter_combo.setCurrentIndex(0)
+        self.search_items()
+
+    def update_tag_filter(self):
+        # Tag counts are queried off the GUI thread, the combo is refilled when they arrive
+        if self.facets_job:
+            self.facets_job.cancel()
+        self.facets_job = QueryJob(database.tag_facets, self.item_type)
+        self.facets_job.signals.finished.connect(self.on_facets_loaded)
+        query_pool().start(self.facets_job)
+
+    def on_facets_loaded(self, facets):
+        # Offer the most common tags as filters, keeping the current choice if it still exists
+        self.facets_job = None
+        selected = self.tag_filter_combo.currentData()
+        self.tag_filter_combo.clear()
+        self.tag_filter_combo.addItem("All tags", None)
+        for tag, count in facets:
+            self.tag_filter_combo.addItem(f"{tag} ({count})", tag)
+        index = self.tag_filter_combo.findData(selected)
+        self.tag_filter_combo.setCurrentIndex(max(index, 0))
+
+    def search_items(self):
+        self.search_timer.stop()
+        search_term = self.search_input.text().strip().lower()
+        # Only the first page is queried here, the view fetches more as it scrolls.
+        # An unchanged search only adds the items reported since it was last shown
+        with metrics.span("browse.show"):
+            self.item_model.set_search(search_term, self.tag_filter_combo.currentData(),
+                                       self.include_archived_checkbox.isChecked())
 
     def show_existing_items(self):
-        # Clear the existing layout
-        while self.existing_list_layout.count():
-            child = self.existing_list_layout.takeAt(0)
-            if child.widget():
-                child.widget().deleteLater()
+        self.update_tag_filter()
+        self.search_items()
+        self.stacked_layout.setCurrentIndex(1)
 
-        search_term = self.search_input.text().strip().lower()
+    def on_items_loaded(self):
+        self.no_items_label.setVisible(self.item_model.rowCount() == 0)
+
+    def on_items_failed(self, error):
+        QMessageBox.critical(
+            self, 
+            "Database Error", 
+            f"Could not load items:\n\n{error}"
+        )
+
+    def show_item_menu(self, position):
+        index = self.item_view.indexAt(position)
+        if not index.isValid():
+            return
+        menu = QMenu(self)
+        similar_action = menu.addAction("Find visually similar items")
+        resolved_action = menu.addAction("Mark as resolved")
+        action = menu.exec_(self.item_view.viewport().mapToGlobal(position))
+        if action == similar_action:
+            self.find_similar_items(index.data(ItemIdRole))
+        elif action == resolved_action:
+            self.mark_resolved(index.data(ItemIdRole))
+
+    def mark_resolved(self, item_id):
         conn = None
         try:
-            conn = sqlite3.connect(DATABASE_FILE)
-            cursor = conn.cursor()
-            
-            if search_term:
-                cursor.execute("""
-                    SELECT image_path, tags, location, date_reported 
-                    FROM items 
-                    WHERE item_type=? AND (LOWER(tags) LIKE ? OR LOWER(location) LIKE ?)
-                    ORDER BY date_reported DESC
-                """, (self.item_type, f"%{search_term}%", f"%{search_term}%"))
-            else:
-                cursor.execute("""
-                    SELECT image_path, tags, location, date_reported 
-                    FROM items 
-                    WHERE item_type=? 
-                    ORDER BY date_reported DESC
-                """, (self.item_type,))
-                
-            items = cursor.fetchall()
-
-            if not items:
-                no_items_label = QLabel(f"No reported {self.item_type.lower()} items found.")
-                no_items_label.setAlignment(Qt.AlignCenter)
-                self.existing_list_layout.addWidget(no_items_label)
-            else:
-                screen_width = QDesktopWidget().screenGeometry().width()
-                image_width = int(screen_width * 0.4)
-
-                for image_path, tags, location, date_reported in items:
-                    item_widget = QWidget()
-                    item_layout = QVBoxLayout(item_widget)
-                    item_layout.setContentsMargins(10, 10, 10, 10)
-                    item_layout.setSpacing(10)
-
-                    # Image display
-                    try:
-                        if os.path.exists(image_path):
-                            pixmap = QPixmap(image_path)
-                            if not pixmap.isNull():
-                                pixmap = pixmap.scaledToWidth(image_width, Qt.SmoothTransformation)
-                                image_label = QLabel()
-                                image_label.setPixmap(pixmap)
-                                image_label.setAlignment(Qt.AlignCenter)
-                                item_layout.addWidget(image_label)
-                            else:
-                                error_label = QLabel("Invalid image file")
-                                error_label.setAlignment(Qt.AlignCenter)
-                                item_layout.addWidget(error_label)
-                        else:
-                            error_label = QLabel("Image not found")
-                            error_label.setAlignment(Qt.AlignCenter)
-                            item_layout.addWidget(error_label)
-                    except Exception as e:
-                        error_label = QLabel(f"Error loading image: {str(e)}")
-                        error_label.setAlignment(Qt.AlignCenter)
-                        item_layout.addWidget(error_label)
-
-                    # Tags, location and date
-                    details_widget = QWidget()
-                    details_layout = QVBoxLayout(details_widget)
-                    details_layout.setContentsMargins(5, 5, 5, 5)
-                    details_layout.setSpacing(5)
-
-                    if tags:
-                        tags_label = QLabel(f"<b>Tags:</b> {tags}")
-                        tags_label.setWordWrap(True)
-                        details_layout.addWidget(tags_label)
-
-                    location_label = QLabel(f"<b>Location:</b> {location}")
-                    location_label.setWordWrap(True)
-                    details_layout.addWidget(location_label)
-
-                    date_label = QLabel(f"<small>Reported on: {date_reported}</small>")
-                    date_label.setStyleSheet("color: #666;")
-                    details_layout.addWidget(date_label)
-
-                    item_layout.addWidget(details_widget)
-                    self.existing_list_layout.addWidget(item_widget)
-
-                self.existing_list_layout.addStretch()
-                
+            conn = database.connect()
+            database.mark_resolved(conn, item_id)
+            conn.commit()
+        except sqlite3.Error as e:
+            QMessageBox.critical(
+                self, 
+                "Database Error", 
+                f"Could not mark the item as resolved:\n\n{str(e)}"
+            )
+            return
+        finally:
+            if conn:
+                conn.close()
+        if not self.include_archived_checkbox.isChecked():
+            self.item_model.remove_item(item_id)
+        QThreadPool.globalInstance().start(RetentionJob(days=None))
+
+    def find_similar_items(self, item_id):
+        self.similarity_job = SimilarityJob(item_id, self.item_type, config.SIMILAR_ITEMS_LIMIT)
+        self.similarity_job.signals.finished.connect(self.on_similar_items)
+        self.similarity_job.signals.failed.connect(
+            lambda _, error: QMessageBox.warning(self, "Warning", f"Could not search for similar items:\n\n{error}"))
+        QThreadPool.globalInstance().start(self.similarity_job)
+
+    def on_similar_items(self, item_id, similar_ids):
+        if not similar_ids:
+            QMessageBox.information(self, "No Similar Items", "No visually similar items were found.")
+            return
+        try:
+            self.item_model.set_ids([item_id] + similar_ids)
         except sqlite3.Error as e:
             QMessageBox.critical(
                 self, 
                 "Database Error", 
                 f"Could not load items:\n\n{str(e)}"
             )
+        self.item_view.scrollToTop()
+
+    def show_matches(self):
+        self.matches_list.clear()
+        other_type = matching.OPPOSITE_TYPE[self.item_type]
+        conn = None
+        try:
+            conn = database.connect()
+            matches = matching.matches_for_type(conn, self.item_type)
+        except sqlite3.Error as e:
+            QMessageBox.critical(
+                self, 
+                "Database Error", 
+                f"Could not load matches:\n\n{str(e)}"
+            )
+            matches = []
         finally:
             if conn:
                 conn.close()
 
-        self.stacked_layout.setCurrentIndex(1)
+        if not matches:
+            self.matches_list.addItem("No possible matches found yet.")
+        for item_id, tags, location, other_id, other_tags, other_location, score in matches:
+            self.matches_list.addItem(
+                f"{self.item_type} #{item_id} ({tags or 'no tags'}, {location})\n"
+                f"    matches {other_type} #{other_id} ({other_tags or 'no tags'}, {other_location})"
+                f" - score {score:.2f}"
+            )
+
+        self.stacked_layout.setCurrentIndex(2)
+
 
-app = QApplication(sys.argv)
-app.setStyle("Fusion")
+class DiagnosticsTab(QWidget):
+    # Live view of the timing spans, refreshed while the tab is visible
+    COLUMNS = ["Stage", "Count", "Mean (ms)", "p50 (ms)", "p95 (ms)", "Max (ms)"]
 
-# Set application font
-font = QFont()
-font.setFamily("Arial")
-font.setPointSize(10)
-app.setFont(font)
+    def __init__(self):
+        super().__init__()
+        layout = QVBoxLayout(self)
 
-main_window = MainWindow()
-main_window.show()
-sys.exit(app.exec_())
\ No newline at end of file
+        self.timings_table = QTableWidget(0, len(self.COLUMNS))
+        self.timings_table.setHorizontalHeaderLabels(self.COLUMNS)
+        self.timings_table.horizontalHeader().setSectionResizeMode(QHeaderView.ResizeToContents)
+        self.timings_table.horizontalHeader().setStretchLastSection(True)
+        self.timings_table.setEditTriggers(QTableWidget.NoEditTriggers)
+        layout.addWidget(self.timings_table)
+
+        self.counters_label = QLabel()
+        self.counters_label.setWordWrap(True)
+        layout.addWidget(self.counters_label)
+
+        self.refresh_timer = QTimer(self)
+        self.refresh_timer.setInterval(2000)
+        self.refresh_timer.timeout.connect(self.refresh)
+
+    def showEvent(self, event):
+        super().showEvent(event)
+        self.refresh()
+        self.refresh_timer.start()
+
+    def hideEvent(self, event):
+        super().hideEvent(event)
+        self.refresh_timer.stop()
+
+    def refresh(self):
+        rows = metrics.summary()
+        self.timings_table.setRowCount(len(rows))
+        for row, (name, count, mean, p50, p95, maximum) in enumerate(rows):
+            values = [name, str(count)] + [f"{value:.1f}" for value in (mean, p50, p95, maximum)]
+            for column, value in enumerate(values):
+                item = QTableWidgetItem(value)
+                if column:
+                    item.setTextAlignment(Qt.AlignRight | Qt.AlignVCenter)
+                self.timings_table.setItem(row, column, item)
+
+        counters = metrics.registry.snapshot()["counters"]
+        self.counters_label.setText("Counters: " + (", ".join(f"{name} {value}" for name, value in counters.items())
+                                                    or "none yet"))
+
+
+def main():
+    mark_startup("imports")
+    app = QApplication(sys.argv)
+    app.setStyle("Fusion")
+
+    # Set application font
+    font = QFont()
+    font.setFamily("Arial")
+    font.setPointSize(10)
+    app.setFont(font)
+
+    metrics.setup()
+    main_window = MainWindow()
+    main_window.show()
+    # Runs on the first event loop iteration, after the window has been painted
+    QTimer.singleShot(0, main_window.start_background_work)
+    sys.exit(app.exec_())
+
+if __name__ == "__main__":
+    main()
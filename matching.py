@@ -0,0 +1,182 @@
+import argparse
+import math
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import config
+import database
+
+OPPOSITE_TYPE = {"Lost": "Found", "Found": "Lost"}
+# SQLite limits the number of bound parameters per statement
+CHUNK_SIZE = 500
+
+
+class MatchItem:
+    def __init__(self, item_id, item_type, area, building, floor, date_reported, reported_day, tags):
+        self.item_id = item_id
+        self.item_type = item_type
+        self.area = area
+        self.building = building
+        self.floor = floor
+        self.date_reported = date_reported
+        self.reported_day = reported_day
+        self.tags = tags
+
+
+def load_items(conn, item_ids):
+    items = {}
+    item_ids = list(item_ids)
+    for start in range(0, len(item_ids), CHUNK_SIZE):
+        chunk = item_ids[start:start + CHUNK_SIZE]
+        placeholders = ",".join("?" * len(chunk))
+        for row in conn.execute(f"""
+            SELECT id, item_type, area, building, floor, date_reported, julianday(date_reported)
+            FROM items WHERE id IN ({placeholders})
+        """, chunk):
+            items[row[0]] = MatchItem(*row, set())
+        for item_id, tag in conn.execute(f"""
+            SELECT item_id, tag FROM item_tags WHERE item_id IN ({placeholders})
+        """, chunk):
+            if item_id in items:
+                items[item_id].tags.add(tag)
+    return items
+
+
+def candidate_ids(conn, item):
+    # Only items sharing a tag within the time window are scored, reported in the same building
+    # first and then closest in time. The window and the cap keep the cost of a report flat
+    if not item.tags or not item.date_reported:
+        return set()
+    window = config.MATCH_WINDOW_DAYS
+    tags = list(item.tags)
+    placeholders = ",".join("?" * len(tags))
+    return {row[0] for row in conn.execute(f"""
+        SELECT id FROM items
+        WHERE item_type=?
+          AND date_reported BETWEEN datetime(?, ?) AND datetime(?, ?)
+          AND EXISTS (SELECT 1 FROM item_tags WHERE item_id = items.id AND tag IN ({placeholders}))
+        ORDER BY area IS ? AND building IS ? DESC, ABS(julianday(date_reported) - julianday(?))
+        LIMIT ?
+    """, [OPPOSITE_TYPE[item.item_type], item.date_reported, f"-{window} days", item.date_reported,
+          f"+{window} days"] + tags + [item.area, item.building, item.date_reported, config.MATCH_MAX_CANDIDATES])}
+
+
+def location_score(a, b):
+    # area -> building -> floor, each level only counts if the one above it matches
+    if not a.area or a.area != b.area:
+        return 0.0
+    score = 0.3
+    if a.building and a.building == b.building:
+        score += 0.4
+        no_floor = ("", "Not applicable", None)
+        if a.floor in no_floor or b.floor in no_floor or a.floor == b.floor:
+            score += 0.3
+    return score
+
+
+def match_score(a, b):
+    union = a.tags | b.tags
+    tag_score = len(a.tags & b.tags) / len(union) if union else 0.0
+    days = abs(a.reported_day - b.reported_day) if a.reported_day and b.reported_day else 0.0
+    time_score = math.exp(-days / config.MATCH_TIME_SCALE_DAYS)
+    return (config.MATCH_TAG_WEIGHT * tag_score
+            + config.MATCH_LOCATION_WEIGHT * location_score(a, b)
+            + config.MATCH_TIME_WEIGHT * time_score)
+
+
+def compute_matches(conn, item_id):
+    item = load_items(conn, [item_id]).get(item_id)
+    if item is None or item.item_type not in OPPOSITE_TYPE:
+        return []
+
+    matches = []
+    for candidate in load_items(conn, candidate_ids(conn, item)).values():
+        # Location and time alone reach MATCH_MIN_SCORE, two different objects are never a match
+        if not item.tags & candidate.tags:
+            continue
+        score = match_score(item, candidate)
+        if score >= config.MATCH_MIN_SCORE:
+            if item.item_type == "Lost":
+                matches.append((item.item_id, candidate.item_id, score))
+            else:
+                matches.append((candidate.item_id, item.item_id, score))
+    return matches
+
+
+def save_matches(cursor, matches):
+    cursor.executemany("""
+        INSERT INTO matches (lost_id, found_id, score) VALUES (?, ?, ?)
+        ON CONFLICT (lost_id, found_id) DO UPDATE SET score = excluded.score
+    """, matches)
+
+
+def score_item(conn, item_id):
+    # Called right after an insert, in the same transaction
+    matches = compute_matches(conn, item_id)
+    save_matches(conn.cursor(), matches)
+    return matches
+
+
+def matches_for_type(conn, item_type, limit=200):
+    side, other = ("lost_id", "found_id") if item_type == "Lost" else ("found_id", "lost_id")
+    return conn.execute(f"""
+        SELECT mine.id, mine.tags, mine.location, theirs.id, theirs.tags, theirs.location, matches.score
+        FROM matches
+        JOIN items AS mine ON mine.id = matches.{side}
+        JOIN items AS theirs ON theirs.id = matches.{other}
+        ORDER BY matches.score DESC
+        LIMIT ?
+    """, (limit,)).fetchall()
+
+
+def score_chunk(lost_ids):
+    # Runs in a worker process with its own connection
+    conn = database.connect()
+    try:
+        matches = []
+        for lost_id in lost_ids:
+            matches += compute_matches(conn, lost_id)
+        return matches
+    finally:
+        conn.close()
+
+
+def rescore_all(workers=None):
+    conn = database.connect()
+    try:
+        database.migrate(conn)
+        lost_ids = [row[0] for row in conn.execute("SELECT id FROM items WHERE item_type='Lost' ORDER BY id")]
+        chunks = [lost_ids[start:start + CHUNK_SIZE] for start in range(0, len(lost_ids), CHUNK_SIZE)]
+
+        start = time.perf_counter()
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(score_chunk, chunks))
+
+        # Replace all matches in one transaction so readers never see a half rebuilt table
+        cursor = conn.cursor()
+        # Matches of archived reports are kept, only those between current reports are rebuilt
+        cursor.execute("""
+            DELETE FROM matches
+            WHERE lost_id IN (SELECT id FROM items) AND found_id IN (SELECT id FROM items)
+        """)
+        count = 0
+        for matches in results:
+            save_matches(cursor, matches)
+            count += len(matches)
+        conn.commit()
+        print(f"Scored {len(lost_ids)} lost items in {time.perf_counter() - start:.1f}s, {count} matches")
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Match lost items against found items.")
+    parser.add_argument("--rescore", action="store_true", help="rebuild every match from scratch")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    args = parser.parse_args(sys.argv[1:])
+    if args.rescore:
+        rescore_all(args.workers)
+    else:
+        parser.print_help()
@@ -0,0 +1,230 @@
+import bisect
+import json
+import logging
+import logging.handlers
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import config
+
+# Upper bounds of the latency histogram buckets, in seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+PREFIX = "lostandfound_"
+
+enabled = config.METRICS_ENABLED
+
+
+class Counter:
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        with self._lock:
+            self.counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.count += 1
+            self.sum += value
+            self.max = max(self.max, value)
+
+    def quantile(self, q):
+        # Estimated from the buckets, linear within the bucket the quantile falls in
+        with self._lock:
+            if not self.count:
+                return None
+            rank = q * self.count
+            seen = 0
+            for index, count in enumerate(self.counts):
+                if seen + count >= rank and count:
+                    lower = self.buckets[index - 1] if index else 0.0
+                    upper = self.buckets[index] if index < len(self.buckets) else self.max
+                    return min(lower + (upper - lower) * (rank - seen) / count, self.max)
+                seen += count
+            return self.max
+
+    def snapshot(self):
+        with self._lock:
+            return {"count": self.count, "sum": self.sum, "max": self.max, "counts": list(self.counts)}
+
+
+class Registry:
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    def counter(self, name):
+        counter = self.counters.get(name)
+        if counter is None:
+            with self._lock:
+                counter = self.counters.setdefault(name, Counter())
+        return counter
+
+    def histogram(self, name):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            with self._lock:
+                histogram = self.histograms.setdefault(name, Histogram())
+        return histogram
+
+    def snapshot(self):
+        with self._lock:
+            counters = dict(self.counters)
+            histograms = dict(self.histograms)
+        return {
+            "counters": {name: counter.value for name, counter in sorted(counters.items())},
+            "histograms": {name: histogram.snapshot() for name, histogram in sorted(histograms.items())},
+        }
+
+    def prometheus_text(self):
+        snapshot = self.snapshot()
+        lines = []
+        for name, value in snapshot["counters"].items():
+            metric = metric_name(name) + "_total"
+            lines += [f"# TYPE {metric} counter", f"{metric} {value}"]
+        for name, histogram in snapshot["histograms"].items():
+            metric = metric_name(name) + "_seconds"
+            lines.append(f"# TYPE {metric} histogram")
+            cumulative = 0
+            for bound, count in zip(BUCKETS, histogram["counts"]):
+                cumulative += count
+                lines.append(f'{metric}_bucket{{le="{bound}"}} {cumulative}')
+            lines.append(f'{metric}_bucket{{le="+Inf"}} {histogram["count"]}')
+            lines.append(f"{metric}_sum {histogram['sum']}")
+            lines.append(f"{metric}_count {histogram['count']}")
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+
+def metric_name(name):
+    return PREFIX + re.sub(r"[^a-zA-Z0-9_]", "_", name)
+
+
+class Span:
+    __slots__ = ("name", "start")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        registry.histogram(self.name).observe(time.perf_counter() - self.start)
+        if exc_type is not None:
+            registry.counter(self.name + ".errors").inc()
+
+
+class NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return None
+
+
+NULL_SPAN = NullSpan()
+
+
+def span(name):
+    # Times the enclosed block, when metrics are off this only returns a shared object that does nothing
+    return Span(name) if enabled else NULL_SPAN
+
+
+def count(name, amount=1):
+    if enabled:
+        registry.counter(name).inc(amount)
+
+
+def observe(name, seconds):
+    if enabled:
+        registry.histogram(name).observe(seconds)
+
+
+def summary():
+    # Rows for the diagnostics tab: name, count, mean, p50, p95 and max in milliseconds
+    rows = []
+    with registry._lock:
+        histograms = sorted(registry.histograms.items())
+    for name, histogram in histograms:
+        if histogram.count:
+            rows.append((name, histogram.count, histogram.sum / histogram.count * 1000,
+                         histogram.quantile(0.5) * 1000, histogram.quantile(0.95) * 1000, histogram.max * 1000))
+    return rows
+
+
+def start_log(path=config.METRICS_LOG_FILE, interval=config.METRICS_LOG_INTERVAL):
+    logger = logging.getLogger("lostandfound.metrics")
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    handler = logging.handlers.RotatingFileHandler(path, maxBytes=config.METRICS_LOG_MAX_BYTES,
+                                                   backupCount=config.METRICS_LOG_BACKUPS)
+    logger.addHandler(handler)
+
+    def write_snapshots():
+        while True:
+            time.sleep(interval)
+            snapshot = registry.snapshot()
+            snapshot["time"] = time.strftime("%Y-%m-%dT%H:%M:%S")
+            logger.info(json.dumps(snapshot))
+
+    threading.Thread(target=write_snapshots, name="metrics-log", daemon=True).start()
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = registry.prometheus_text().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_server(port=config.METRICS_PORT):
+    # Only listens on localhost, the endpoint is meant for a scraper on the same machine
+    server = ThreadingHTTPServer(("127.0.0.1", port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    return server
+
+
+def setup():
+    if not enabled:
+        return
+    if config.METRICS_LOG_INTERVAL > 0:
+        try:
+            start_log()
+        except OSError as e:
+            print(f"Could not open metrics log: {e}")
+    if config.METRICS_PORT:
+        try:
+            start_server()
+            print(f"Serving metrics on http://127.0.0.1:{config.METRICS_PORT}/metrics")
+        except OSError as e:
+            print(f"Could not start metrics server: {e}")
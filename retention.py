@@ -0,0 +1,125 @@
+import argparse
+import os
+import sys
+import time
+
+import config
+import database
+import image_store
+import metrics
+
+ARCHIVE_COLUMNS = ["id", "item_type", "image_path", "tags", "location", "area", "building", "floor",
+                   "specific_location", "date_reported", "image_hash", "resolved"]
+# Pause between batches, so the app can take the write lock in between
+BATCH_PAUSE = 0.05
+
+
+def archive_candidates(conn, days, limit):
+    # Resolved reports first, then the oldest ones of each type, each found through its own index.
+    # Without days only resolved reports are archived
+    item_ids = [row[0] for row in conn.execute("SELECT id FROM items WHERE resolved = 1 LIMIT ?", (limit,))]
+    for item_type in ("Lost", "Found"):
+        if days is None or len(item_ids) >= limit:
+            break
+        item_ids += [row[0] for row in conn.execute("""
+            SELECT id FROM items
+            WHERE item_type=? AND date_reported < datetime('now', ?)
+            ORDER BY date_reported LIMIT ?
+        """, (item_type, f"-{days} days", limit - len(item_ids)))]
+    return list(dict.fromkeys(item_ids))[:limit]
+
+
+def archive_batch(conn, item_ids):
+    placeholders = ",".join("?" * len(item_ids))
+    columns = ", ".join(ARCHIVE_COLUMNS)
+    image_paths = [row[0] for row in conn.execute(
+        f"SELECT DISTINCT image_path FROM items WHERE id IN ({placeholders})", item_ids)]
+    # Copy and delete in one short transaction. Tags, matches and embeddings stay, the delete
+    # triggers skip rows that are in the archive
+    conn.execute(f"INSERT OR REPLACE INTO items_archive ({columns}) "
+                 f"SELECT {columns} FROM items WHERE id IN ({placeholders})", item_ids)
+    conn.execute(f"DELETE FROM items WHERE id IN ({placeholders})", item_ids)
+    conn.commit()
+    return image_paths
+
+
+def move_to_cold_storage(conn, image_paths, cold_directory):
+    # An image moves once no current report uses it any more. The archive rows are pointed at the
+    # copy before the original is removed, so an interrupted run never loses an image
+    moved = []
+    cold_prefix = os.path.join(cold_directory, "")
+    for image_path in image_paths:
+        if image_path.startswith(cold_prefix) or not os.path.exists(image_path):
+            continue
+        if conn.execute("SELECT 1 FROM items WHERE image_path=? LIMIT 1", (image_path,)).fetchone():
+            continue
+        cold_path, _ = image_store.import_object(image_path, image_store.object_name(image_path), cold_directory)
+        moved.append((cold_path, image_path))
+    if not moved:
+        return 0
+    conn.executemany("UPDATE items_archive SET image_path=? WHERE image_path=?", moved)
+    conn.commit()
+    for _, image_path in moved:
+        image_store.remove_if_unreferenced(conn, image_path)
+    return len(moved)
+
+
+def archive_items(days=config.RETENTION_DAYS, batch_size=config.RETENTION_BATCH_SIZE,
+                  cold_directory=config.COLD_STORAGE_DIRECTORY):
+    # Returns how many reports were archived and how many images moved to cold storage
+    archived = 0
+    moved = 0
+    conn = database.connect()
+    try:
+        database.migrate(conn)
+        while True:
+            item_ids = archive_candidates(conn, days, batch_size)
+            if not item_ids:
+                break
+            with metrics.span("retention.batch"):
+                image_paths = archive_batch(conn, item_ids)
+                moved += move_to_cold_storage(conn, image_paths, cold_directory)
+            archived += len(item_ids)
+            metrics.count("retention.archived", len(item_ids))
+            if len(item_ids) < batch_size:
+                break
+            time.sleep(BATCH_PAUSE)
+    finally:
+        conn.close()
+    return archived, moved
+
+
+def print_stats():
+    conn = database.connect()
+    try:
+        database.migrate(conn)
+        for table in ("items", "items_archive"):
+            print(f"{table}:")
+            for item_type, count, oldest in conn.execute(
+                    f"SELECT item_type, COUNT(*), MIN(date_reported) FROM {table} GROUP BY item_type"):
+                print(f"  {item_type}: {count} reports, oldest from {oldest}")
+        resolved = conn.execute("SELECT COUNT(*) FROM items WHERE resolved = 1").fetchone()[0]
+        print(f"{resolved} resolved reports waiting to be archived")
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Move old and resolved reports to the archive.")
+    parser.add_argument("--archive", action="store_true", help="archive old and resolved reports now")
+    parser.add_argument("--stats", action="store_true", help="show how many reports each partition holds")
+    parser.add_argument("--days", type=int, default=config.RETENTION_DAYS,
+                        help="archive reports older than this many days")
+    parser.add_argument("--batch-size", type=int, default=config.RETENTION_BATCH_SIZE)
+    parser.add_argument("--cold-directory", default=config.COLD_STORAGE_DIRECTORY,
+                        help="where images of archived reports are kept")
+    args = parser.parse_args(sys.argv[1:])
+    if args.archive:
+        start = time.perf_counter()
+        archived, moved = archive_items(args.days, args.batch_size, args.cold_directory)
+        print(f"Archived {archived} reports and moved {moved} images to {args.cold_directory} "
+              f"in {time.perf_counter() - start:.1f}s")
+    if args.stats:
+        print_stats()
+    if not args.archive and not args.stats:
+        parser.print_help()
@@ -0,0 +1,309 @@
+import argparse
+import asyncio
+import json
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs, urlsplit
+
+import config
+import database
+import duplicates
+import image_store
+import matching
+import metrics
+from image_detection import cached_detections_batch, get_detector
+
+MAX_BODY_BYTES = 1024 * 1024
+REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+           413: "Payload Too Large", 500: "Internal Server Error", 501: "Not Implemented"}
+
+
+class RequestError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class DetectionBatcher:
+    # Requests arriving within max_wait of each other share one model call
+    def __init__(self, model_executor, max_batch=config.SERVICE_BATCH_SIZE,
+                 max_wait=config.SERVICE_BATCH_WAIT_MS / 1000):
+        self.model_executor = model_executor
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.queue = asyncio.Queue()
+
+    async def detect(self, image_path):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((image_path, future))
+        return await future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            metrics.count("service.batches")
+            metrics.count("service.batched_requests", len(batch))
+            await self.detect_batch(batch)
+
+    async def detect_batch(self, batch):
+        loop = asyncio.get_running_loop()
+        paths = [image_path for image_path, _ in batch]
+        try:
+            results = await loop.run_in_executor(self.model_executor, cached_detections_batch, paths)
+        except Exception as e:
+            if len(batch) == 1:
+                _, future = batch[0]
+                if not future.done():
+                    future.set_exception(e)
+                return
+            # One unreadable image must not fail everybody else's request
+            for request in batch:
+                await self.detect_batch([request])
+            return
+        for (_, future), detections in zip(batch, results):
+            if not future.done():
+                future.set_result(detections)
+
+
+class DetectionServer:
+    def __init__(self, store_directory, max_batch, max_wait):
+        # The model is used from one thread at a time, database work gets its own threads
+        self.model_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="model")
+        self.database_executor = ThreadPoolExecutor(max_workers=config.SQLITE_POOL_SIZE, thread_name_prefix="db")
+        self.batcher = DetectionBatcher(self.model_executor, max_batch, max_wait)
+        self.store_directory = store_directory
+        self.routes = {
+            ("GET", "/health"): self.health,
+            ("POST", "/detect"): self.detect,
+            ("POST", "/embed"): self.embed,
+            ("POST", "/items"): self.submit,
+            ("GET", "/items"): self.list_items,
+            ("GET", "/search"): self.search,
+        }
+
+    async def start(self, host, port, unix_socket=None):
+        loop = asyncio.get_running_loop()
+        loop.create_task(self.batcher.run())
+        self.model_executor.submit(self.load_model)
+        if unix_socket:
+            if os.path.exists(unix_socket):
+                os.remove(unix_socket)
+            server = await asyncio.start_unix_server(self.handle_connection, path=unix_socket)
+            print(f"Serving on unix://{unix_socket}")
+        else:
+            server = await asyncio.start_server(self.handle_connection, host, port)
+            print(f"Serving on http://{host}:{port}")
+        return server
+
+    def load_model(self):
+        try:
+            get_detector().load()
+        except Exception as e:
+            print(f"Could not load the detection model: {e}")
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                method, target, _ = request_line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+
+                length = int(headers.get("content-length") or 0)
+                if length > MAX_BODY_BYTES:
+                    await self.respond(writer, 413, {"error": "Request body too large"})
+                    break
+                body = await reader.readexactly(length) if length else b""
+                status, payload = await self.dispatch(method, target, body)
+                await self.respond(writer, status, payload)
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def respond(self, writer, status, payload):
+        body = json.dumps(payload).encode()
+        writer.write(f"HTTP/1.1 {status} {REASONS[status]}\r\n"
+                     f"Content-Type: application/json\r\nContent-Length: {len(body)}\r\n\r\n".encode() + body)
+        await writer.drain()
+
+    async def dispatch(self, method, target, body):
+        url = urlsplit(target)
+        handler = self.routes.get((method, url.path))
+        if handler is None:
+            known = any(path == url.path for _, path in self.routes)
+            return (405, {"error": "Method not allowed"}) if known else (404, {"error": "Not found"})
+        try:
+            params = {name: values[-1] for name, values in parse_qs(url.query).items()}
+            data = json.loads(body) if body else {}
+            with metrics.span(f"service.{method.lower()}{url.path.replace('/', '_')}"):
+                return 200, await handler(params, data)
+        except RequestError as e:
+            return e.status, {"error": str(e)}
+        except (KeyError, TypeError, ValueError) as e:
+            return 400, {"error": f"Invalid request: {e}"}
+        except Exception as e:
+            print(f"{method} {url.path} failed: {e}")
+            return 500, {"error": str(e)}
+
+    def in_database(self, function, *args):
+        return asyncio.get_running_loop().run_in_executor(self.database_executor, function, *args)
+
+    async def health(self, params, data):
+        detector = get_detector()
+        return {"status": "ok", "model": detector.model_name, "model_loaded": detector.is_loaded()}
+
+    async def detect(self, params, data):
+        image_path = image_file(data["path"])
+        try:
+            detections = await self.batcher.detect(image_path)
+        except Exception as e:
+            raise RequestError(500, f"Detection failed: {e}") from e
+        return {"detections": detections}
+
+    async def embed(self, params, data):
+        paths = [image_file(path) for path in data["paths"]]
+        detector = get_detector()
+        if not detector.can_embed():
+            raise RequestError(501, f"Embeddings are disabled for the {detector.backend.format} backend")
+        vectors = await asyncio.get_running_loop().run_in_executor(self.model_executor, detector.embed, paths)
+        return {"model": detector.embedding_name, "vectors": [vector.tolist() for vector in vectors]}
+
+    async def submit(self, params, data):
+        item_type = data["item_type"]
+        if item_type not in matching.OPPOSITE_TYPE:
+            raise RequestError(400, f"Unknown item type {item_type!r}")
+        source_path = image_file(data["image_path"])
+        detections = data.get("detections")
+        if detections is None:
+            detections = (await self.batcher.detect(source_path))[:2]
+        item_id, save_path, matches = await self.in_database(self.save_item, item_type, source_path, detections, data)
+        # The embedding is not needed for the response, compute it once the model is free
+        self.model_executor.submit(self.save_embedding, item_id, save_path)
+        return {"id": item_id, "image_path": save_path, "detections": detections, "matches": len(matches)}
+
+    def save_item(self, item_type, source_path, detections, data):
+        save_path, created = image_store.store_image(source_path, self.store_directory)
+        area, building = data["area"], data["building"]
+        floor, specific_location = data.get("floor", ""), data["specific_location"]
+        location = database.format_location(area, building, floor, specific_location)
+        try:
+            image_hash = duplicates.to_signed(duplicates.image_hash(save_path))
+        except OSError:
+            image_hash = None
+        conn = database.connect()
+        try:
+            item_id = database.insert_item(conn.cursor(), item_type, save_path, [tuple(d) for d in detections],
+                                           location, area, building, floor, specific_location, image_hash)
+            matches = matching.score_item(conn, item_id)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            if created:
+                image_store.remove_if_unreferenced(conn, save_path)
+            raise
+        finally:
+            conn.close()
+        return item_id, save_path, matches
+
+    def save_embedding(self, item_id, image_path):
+        import embeddings
+
+        conn = None
+        try:
+            detector = get_detector()
+            if not detector.can_embed():
+                return
+            vector = detector.embed([image_path])[0]
+            conn = database.connect()
+            embeddings.save_embedding(conn.cursor(), item_id, vector, detector.embedding_name)
+            conn.commit()
+        except Exception as e:
+            print(f"Could not compute embedding for item {item_id}: {e}")
+        finally:
+            if conn:
+                conn.close()
+
+    async def list_items(self, params, data):
+        after = (params["after_date"], int(params["after_id"])) if "after_id" in params else None
+        limit = min(int(params.get("limit", config.LIST_PAGE_SIZE)), 500)
+        rows = await self.in_database(self.query, database.fetch_items_page, params["type"], after, limit,
+                                      params.get("tag"), params.get("archived") == "1")
+        return {"items": rows}
+
+    async def search(self, params, data):
+        limit = min(int(params.get("limit", config.LIST_PAGE_SIZE)), 500)
+        rows = await self.in_database(self.query, database.search_items_page, params["type"], params.get("q", ""),
+                                      int(params.get("offset", 0)), limit, params.get("tag"),
+                                      params.get("archived") == "1")
+        return {"items": rows}
+
+    def query(self, function, *args):
+        conn = database.connect()
+        try:
+            rows = function(conn, *args)
+        finally:
+            conn.close()
+        return [{"id": item_id, "image_path": image_path, "tags": tags, "location": location,
+                 "date_reported": date_reported}
+                for item_id, image_path, tags, location, date_reported in rows]
+
+
+def image_file(path):
+    if not isinstance(path, str) or not os.path.isfile(path):
+        raise RequestError(400, f"Image {path!r} does not exist on the server")
+    return path
+
+
+async def serve(args):
+    conn = database.connect()
+    try:
+        database.migrate(conn)
+    finally:
+        conn.close()
+    metrics.setup()
+    server = DetectionServer(args.save_directory, args.batch_size, args.max_wait_ms / 1000)
+    listener = await server.start(args.host, args.port, args.unix_socket)
+    async with listener:
+        await listener.serve_forever()
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Serve object detection and the item database to local clients.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--unix-socket", help="listen on this Unix socket instead of TCP")
+    parser.add_argument("--batch-size", type=int, default=config.SERVICE_BATCH_SIZE,
+                        help="most images detected in one model call")
+    parser.add_argument("--max-wait-ms", type=float, default=config.SERVICE_BATCH_WAIT_MS,
+                        help="how long a request waits for others to share its model call")
+    parser.add_argument("--save-directory", default=image_store.STORE_DIRECTORY,
+                        help="where images of items submitted through the service are stored")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(serve(parse_args(sys.argv[1:])))
+    except KeyboardInterrupt:
+        pass
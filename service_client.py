@@ -0,0 +1,63 @@
+import http.client
+import json
+import os
+import socket
+from urllib.parse import urlsplit
+
+import config
+
+
+class ServiceError(Exception):
+    pass
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path, timeout):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+def open_connection(url, timeout):
+    parts = urlsplit(url)
+    if parts.scheme == "unix":
+        return UnixHTTPConnection(parts.path, timeout)
+    if parts.scheme == "http":
+        return http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=timeout)
+    raise ServiceError(f"Unsupported service URL {url!r}, expected http:// or unix://")
+
+
+def request(method, path, payload=None, url=None, timeout=config.SERVICE_TIMEOUT):
+    conn = open_connection(url or config.SERVICE_URL, timeout)
+    try:
+        body = json.dumps(payload).encode() if payload is not None else None
+        headers = {"Content-Type": "application/json"} if body is not None else {}
+        conn.request(method, path, body, headers)
+        response = conn.getresponse()
+        data = json.loads(response.read() or b"{}")
+    except (OSError, http.client.HTTPException, ValueError) as e:
+        raise ServiceError(f"Detection service is not reachable: {e}") from e
+    finally:
+        conn.close()
+    if response.status != 200:
+        raise ServiceError(data.get("error") or f"Detection service answered {response.status}")
+    return data
+
+
+def health():
+    return request("GET", "/health")
+
+
+def detect(image_path):
+    # The service shares this machine, so it reads the image from the same path
+    data = request("POST", "/detect", {"path": os.path.abspath(image_path)})
+    return [(tag, confidence) for tag, confidence in data["detections"]]
+
+
+def embed(image_paths):
+    data = request("POST", "/embed", {"paths": [os.path.abspath(path) for path in image_paths]})
+    return data["model"], data["vectors"]
@@ -0,0 +1,100 @@
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database
+import retention
+import transfer
+
+
+class TransferRoundTripTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.chunk_rows = transfer.CHUNK_ROWS
+        # Small chunks, so the images and the image index both span several of them
+        transfer.CHUNK_ROWS = 3
+
+    def tearDown(self):
+        transfer.CHUNK_ROWS = self.chunk_rows
+        database.use_database(database.DATABASE_FILE)
+        self.directory.cleanup()
+
+    def path(self, *names):
+        return os.path.join(self.directory.name, *names)
+
+    def create_items(self, count):
+        os.makedirs(self.path("images"))
+        conn = database.connect()
+        try:
+            database.migrate(conn)
+            for index in range(count):
+                image_path = self.path("images", f"{index}.jpg")
+                with open(image_path, "wb") as f:
+                    f.write(f"image {index}".encode())
+                database.insert_item(conn.cursor(), "Found", image_path, [("cup", 0.9)], "Dome building",
+                                     "University", "Dome building", "Ground floor", "Library desk", None)
+            conn.commit()
+        finally:
+            conn.close()
+
+    def test_round_trip_with_more_images_than_a_chunk(self):
+        database.use_database(self.path("source.db"))
+        self.create_items(7)
+        archive = self.path("backup.tar")
+        transfer.export_archive(archive)
+
+        database.use_database(self.path("target.db"))
+        store_directory = self.path("objects")
+        transfer.import_archive(archive, store_directory)
+        # A second import finds everything already present
+        transfer.import_archive(archive, store_directory)
+
+        conn = database.connect()
+        try:
+            image_paths = [row[0] for row in conn.execute("SELECT image_path FROM items")]
+        finally:
+            conn.close()
+        self.assertEqual(len(image_paths), 7)
+        self.assertEqual(len(set(image_paths)), 7)
+        for image_path in image_paths:
+            self.assertTrue(image_path.startswith(store_directory))
+            self.assertTrue(os.path.exists(image_path))
+
+    def test_round_trip_keeps_archived_reports(self):
+        database.use_database(self.path("source.db"))
+        self.create_items(4)
+        conn = database.connect()
+        try:
+            database.mark_resolved(conn, 1)
+            conn.commit()
+        finally:
+            conn.close()
+        retention.archive_items(None, cold_directory=self.path("cold"))
+        archive = self.path("backup.tar")
+        transfer.export_archive(archive)
+
+        database.use_database(self.path("target.db"))
+        cold_directory = self.path("target_cold")
+        transfer.import_archive(archive, self.path("objects"), cold_directory)
+        transfer.import_archive(archive, self.path("objects"), cold_directory)
+
+        conn = database.connect()
+        try:
+            self.assertEqual(conn.execute("SELECT COUNT(*) FROM items").fetchone()[0], 3)
+            archived = conn.execute("SELECT id, image_path, resolved FROM items_archive").fetchall()
+            tags = conn.execute("SELECT tag FROM item_tags WHERE item_id=?", (archived[0][0],)).fetchall()
+        finally:
+            conn.close()
+        self.assertEqual(len(archived), 1)
+        _, image_path, resolved = archived[0]
+        self.assertEqual(resolved, 1)
+        self.assertTrue(image_path.startswith(cold_directory))
+        self.assertTrue(os.path.exists(image_path))
+        self.assertEqual(tags, [("cup",)])
+
+
+if __name__ == "__main__":
+    unittest.main()
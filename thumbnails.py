@@ -0,0 +1,95 @@
+import os
+import threading
+
+from PyQt5.QtCore import QSize, Qt
+from PyQt5.QtGui import QImageReader, QPixmap, QPixmapCache
+
+import config
+import metrics
+
+
+def setup_thumbnail_cache():
+    QPixmapCache.setCacheLimit(config.THUMBNAIL_CACHE_KB)
+
+
+def thumbnail_path(item_id, width):
+    return os.path.join(config.THUMBNAIL_DIRECTORY, str(width), f"{item_id}.jpg")
+
+
+def create_thumbnail(item_id, image_path, width):
+    # Also runs on worker threads, so this only uses QImage and never QPixmap
+    with metrics.span("thumbnail.create"):
+        return _create_thumbnail(item_id, image_path, width)
+
+
+def _create_thumbnail(item_id, image_path, width):
+    reader = QImageReader(image_path)
+    reader.setAutoTransform(True)
+    size = reader.size()
+    if size.isValid() and size.width() > width:
+        # Lets the JPEG decoder skip most of the full resolution image
+        reader.setScaledSize(QSize(width, max(1, size.height() * width // size.width())))
+    image = reader.read()
+    if image.isNull():
+        return None
+    if image.width() != width:
+        image = image.scaledToWidth(width, Qt.SmoothTransformation)
+
+    path = thumbnail_path(item_id, width)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Write then rename so the listing never decodes a half written file
+    temp_path = f"{path}.{threading.get_ident()}.tmp"
+    if image.save(temp_path, "JPG", config.THUMBNAIL_QUALITY):
+        os.replace(temp_path, path)
+    return image
+
+
+def create_missing_thumbnails(items, width):
+    created = []
+    failed = []
+    for item_id, image_path in items:
+        if os.path.exists(thumbnail_path(item_id, width)):
+            continue
+        try:
+            if create_thumbnail(item_id, image_path, width) is not None:
+                created.append(item_id)
+            else:
+                failed.append(item_id)
+        except Exception as e:
+            print(f"Could not create thumbnail for item {item_id}: {e}")
+            failed.append(item_id)
+    return created, failed
+
+
+def cache_key(item_id, width):
+    return f"thumbnail:{width}:{item_id}"
+
+
+def cached_thumbnail(item_id, width):
+    pixmap = QPixmapCache.find(cache_key(item_id, width))
+    if pixmap is None or pixmap.isNull():
+        return None
+    return pixmap
+
+
+def has_thumbnail(item_id, width):
+    return cached_thumbnail(item_id, width) is not None or os.path.exists(thumbnail_path(item_id, width))
+
+
+def load_thumbnail(item_id, image_path, width):
+    pixmap = cached_thumbnail(item_id, width)
+    if pixmap is not None:
+        return pixmap
+
+    path = thumbnail_path(item_id, width)
+    if os.path.exists(path):
+        with metrics.span("thumbnail.load"):
+            pixmap = QPixmap(path)
+    else:
+        image = create_thumbnail(item_id, image_path, width)
+        pixmap = QPixmap.fromImage(image) if image is not None else QPixmap()
+    if pixmap.isNull():
+        return None
+
+    QPixmapCache.insert(cache_key(item_id, width), pixmap)
+    return pixmap
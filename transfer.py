@@ -0,0 +1,340 @@
+import argparse
+import base64
+import io
+import json
+import os
+import re
+import sys
+import tarfile
+import tempfile
+import time
+
+import config
+import database
+import image_store
+import retention
+
+FORMAT_VERSION = 2
+# Version 1 archives have no archived reports and no resolved flags
+READABLE_VERSIONS = (1, 2)
+CHUNK_ROWS = 5000
+ITEM_COLUMNS = ["id", "item_type", "image_path", "tags", "location", "area", "building", "floor",
+                "specific_location", "date_reported", "image_hash", "resolved"]
+# Archive members are read back in the order they were written: images before the rows that use them,
+# reports of both tables before the matches between them
+MEMBER_ORDER = ("manifest", "images", "image_index", "items", "archived", "matches")
+
+
+def encode_chunk(rows, data_format):
+    if data_format == "parquet":
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        buffer = io.BytesIO()
+        pq.write_table(pa.Table.from_pylist(rows), buffer, compression="zstd")
+        return buffer.getvalue()
+    return "".join(json.dumps(row) + "\n" for row in rows).encode()
+
+
+def decode_chunk(data, data_format):
+    if data_format == "parquet":
+        import pyarrow.parquet as pq
+
+        return pq.read_table(io.BytesIO(data)).to_pylist()
+    return [json.loads(line) for line in data.decode().splitlines() if line]
+
+
+class ArchiveWriter:
+    # Rows are written as numbered chunks so only one chunk is ever held in memory
+    def __init__(self, tar, data_format):
+        self.tar = tar
+        self.data_format = data_format
+        self.extension = "parquet" if data_format == "parquet" else "jsonl"
+        self.chunks = {}
+
+    def add_bytes(self, name, data):
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mtime = int(time.time())
+        self.tar.addfile(info, io.BytesIO(data))
+
+    def add_rows(self, kind, rows):
+        count = 0
+        chunk = []
+        for row in rows:
+            chunk.append(row)
+            if len(chunk) >= CHUNK_ROWS:
+                self.write_chunk(kind, chunk)
+                count += len(chunk)
+                chunk = []
+        if chunk:
+            self.write_chunk(kind, chunk)
+            count += len(chunk)
+        return count
+
+    def write_chunk(self, kind, rows):
+        number = self.chunks.get(kind, 0)
+        self.chunks[kind] = number + 1
+        self.add_bytes(f"{kind}/{number:06d}.{self.extension}", encode_chunk(rows, self.data_format))
+
+
+def item_rows(conn, table="items"):
+    columns = ITEM_COLUMNS + (["date_archived"] if table == "items_archive" else [])
+    cursor = conn.execute(f"""
+        SELECT {", ".join(f"{table}.{column}" for column in columns)},
+               (SELECT json_group_array(json_array(tag, confidence)) FROM item_tags WHERE item_id = {table}.id),
+               item_embeddings.model, item_embeddings.vector
+        FROM {table}
+        LEFT JOIN item_embeddings ON item_embeddings.item_id = {table}.id
+        ORDER BY {table}.id
+    """)
+    for row in cursor:
+        item = dict(zip(columns, row))
+        item["item_tags"] = row[len(columns)]
+        item["embedding_model"] = row[len(columns) + 1]
+        vector = row[len(columns) + 2]
+        item["embedding"] = base64.b64encode(vector).decode() if vector is not None else None
+        yield item
+
+
+def match_rows(conn):
+    for lost_id, found_id, score, date_matched in conn.execute(
+            "SELECT lost_id, found_id, score, date_matched FROM matches ORDER BY lost_id, found_id"):
+        yield {"lost_id": lost_id, "found_id": found_id, "score": score, "date_matched": date_matched}
+
+
+def export_images(conn, writer, index_file):
+    # Each stored file is archived once, named by its content hash. Old copies of one photo under
+    # different paths share a name and are deduplicated again on import. The path index goes to a
+    # temporary file, its chunks may only follow the last image
+    count = 0
+    for (image_path,) in conn.execute("""
+            SELECT image_path FROM items UNION SELECT image_path FROM items_archive ORDER BY image_path
+            """):
+        if not os.path.exists(image_path):
+            print(f"Image missing, exporting the row without it: {image_path}")
+            continue
+        name = image_store.object_name(image_path)
+        writer.tar.add(image_path, arcname=f"images/{name}", recursive=False)
+        index_file.write(json.dumps({"path": image_path, "name": name}) + "\n")
+        count += 1
+    return count
+
+
+def index_rows(index_file):
+    index_file.seek(0)
+    for line in index_file:
+        yield json.loads(line)
+
+
+def export_archive(output, data_format="jsonl"):
+    start = time.perf_counter()
+    conn = database.connect()
+    try:
+        database.migrate(conn)
+    finally:
+        conn.close()
+    # A dedicated connection holding one read transaction sees a single consistent snapshot,
+    # while the app keeps writing through WAL
+    conn = database.open_connection(database.database_path())
+    try:
+        conn.execute("BEGIN")
+        schema_version = conn.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version").fetchone()[0]
+        mode = "w|gz" if output.endswith((".tar.gz", ".tgz")) else "w|"
+        with tarfile.open(output, mode) as tar:
+            writer = ArchiveWriter(tar, data_format)
+            manifest = {"format_version": FORMAT_VERSION, "schema_version": schema_version,
+                        "data_format": data_format, "created": time.strftime("%Y-%m-%dT%H:%M:%S")}
+            writer.add_bytes("manifest.json", json.dumps(manifest).encode())
+            with tempfile.TemporaryFile("w+") as index_file:
+                images = export_images(conn, writer, index_file)
+                writer.add_rows("image_index", index_rows(index_file))
+            items = writer.add_rows("items", item_rows(conn))
+            archived = writer.add_rows("archived", item_rows(conn, "items_archive"))
+            matches = writer.add_rows("matches", match_rows(conn))
+        conn.rollback()
+    finally:
+        conn.close()
+    print(f"Exported {items} items, {archived} archived items, {images} image references and {matches} matches "
+          f"to {output} in {time.perf_counter() - start:.1f}s")
+
+
+def member_kind(name):
+    kind = name.split("/", 1)[0]
+    return "manifest" if name == "manifest.json" else kind
+
+
+def import_archive(path, store_directory=image_store.STORE_DIRECTORY, cold_directory=config.COLD_STORAGE_DIRECTORY):
+    start = time.perf_counter()
+    conn = database.connect()
+    try:
+        database.migrate(conn)
+        # Id and path mappings live in temporary tables, not in Python. Pooled connections keep
+        # temporary tables in memory, this one spills them to disk so memory stays flat
+        conn.execute("PRAGMA temp_store=FILE")
+        conn.executescript("""
+            CREATE TEMP TABLE IF NOT EXISTS import_objects (name TEXT PRIMARY KEY, path TEXT NOT NULL);
+            CREATE TEMP TABLE IF NOT EXISTS import_paths (old_path TEXT PRIMARY KEY, name TEXT NOT NULL);
+            CREATE TEMP TABLE IF NOT EXISTS import_ids (old_id INTEGER PRIMARY KEY, new_id INTEGER NOT NULL);
+            DELETE FROM import_objects;
+            DELETE FROM import_paths;
+            DELETE FROM import_ids;
+        """)
+        counts = {"images": 0, "items": 0, "archived": 0, "skipped": 0, "matches": 0}
+        data_format = "jsonl"
+        last_kind = 0
+        with tarfile.open(path, "r|*") as tar:
+            for member in tar:
+                kind = member_kind(member.name)
+                if kind not in MEMBER_ORDER or not member.isfile():
+                    continue
+                if MEMBER_ORDER.index(kind) < last_kind:
+                    raise ValueError(f"{member.name} is out of order, the archive was not written by transfer.py")
+                last_kind = MEMBER_ORDER.index(kind)
+                data = tar.extractfile(member)
+
+                if kind == "manifest":
+                    manifest = json.load(data)
+                    if manifest.get("format_version") not in READABLE_VERSIONS:
+                        raise ValueError(f"Unsupported archive format {manifest.get('format_version')}")
+                    data_format = manifest["data_format"]
+                elif kind == "images":
+                    import_image(conn, data, os.path.basename(member.name), store_directory)
+                    counts["images"] += 1
+                elif kind == "image_index":
+                    conn.executemany("INSERT OR REPLACE INTO import_paths (old_path, name) VALUES (?, ?)",
+                                     [(row["path"], row["name"]) for row in decode_chunk(data.read(), data_format)])
+                elif kind == "items":
+                    inserted, skipped = import_items(conn, decode_chunk(data.read(), data_format))
+                    counts["items"] += inserted
+                    counts["skipped"] += skipped
+                elif kind == "archived":
+                    inserted, skipped = import_items(conn, decode_chunk(data.read(), data_format), archived=True)
+                    counts["archived"] += inserted
+                    counts["skipped"] += skipped
+                elif kind == "matches":
+                    counts["matches"] += import_matches(conn, decode_chunk(data.read(), data_format))
+                # Every chunk is its own transaction, an interrupted import keeps what it finished
+                conn.commit()
+        # Images that only archived reports use go to cold storage, as retention.py would have done
+        prefix = os.path.join(store_directory, "")
+        image_paths = [row[0] for row in conn.execute("""
+            SELECT DISTINCT image_path FROM items_archive
+            WHERE substr(image_path, 1, ?) = ? AND image_path NOT IN (SELECT image_path FROM items)
+        """, (len(prefix), prefix))]
+        retention.move_to_cold_storage(conn, image_paths, cold_directory)
+    finally:
+        # Changing temp_store drops the temporary tables before the connection goes back to the pool
+        conn.rollback()
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.close()
+    print(f"Imported {counts['items']} items, {counts['archived']} archived items, {counts['images']} images "
+          f"and {counts['matches']} matches from {path} in {time.perf_counter() - start:.1f}s, "
+          f"{counts['skipped']} items were already present")
+
+
+def import_image(conn, data, name, store_directory):
+    if not re.fullmatch(r"[0-9a-f]{64}\.\w+", name):
+        raise ValueError(f"Unexpected image name {name!r} in archive")
+    handle, temp_path = tempfile.mkstemp(suffix=os.path.splitext(name)[1])
+    try:
+        with os.fdopen(handle, "wb") as f:
+            while True:
+                block = data.read(1024 * 1024)
+                if not block:
+                    break
+                f.write(block)
+        stored_path, _ = image_store.import_object(temp_path, name, store_directory)
+    finally:
+        os.remove(temp_path)
+    conn.execute("INSERT OR REPLACE INTO import_objects (name, path) VALUES (?, ?)", (name, stored_path))
+
+
+def find_existing(cursor, row, image_path):
+    # The same report imported twice is kept once, also when it has been archived since. Archived
+    # images may have moved to cold storage, so those rows are compared without their path
+    existing = cursor.execute("""
+        SELECT id FROM items
+        WHERE item_type=? AND date_reported IS ? AND image_path=? AND location IS ?
+    """, (row["item_type"], row["date_reported"], image_path, row["location"])).fetchone()
+    if existing:
+        return existing
+    return cursor.execute("""
+        SELECT id FROM items_archive
+        WHERE item_type=? AND date_reported IS ? AND location IS ? AND tags IS ? AND image_hash IS ?
+    """, (row["item_type"], row["date_reported"], row["location"], row["tags"], row["image_hash"])).fetchone()
+
+
+def import_items(conn, rows, archived=False):
+    # Archived reports are inserted like current ones and then moved, so their ids come from the
+    # same sequence and never collide with a later report
+    cursor = conn.cursor()
+    inserted = 0
+    skipped = 0
+    archived_ids = []
+    for row in rows:
+        found = cursor.execute("""
+            SELECT import_objects.path FROM import_paths
+            JOIN import_objects ON import_objects.name = import_paths.name
+            WHERE import_paths.old_path=?
+        """, (row["image_path"],)).fetchone()
+        image_path = found[0] if found else row["image_path"]
+
+        existing = find_existing(cursor, row, image_path)
+        if existing:
+            cursor.execute("INSERT OR REPLACE INTO import_ids (old_id, new_id) VALUES (?, ?)", (row["id"], existing[0]))
+            skipped += 1
+            continue
+
+        cursor.execute("""
+            INSERT INTO items (item_type, image_path, tags, location, area, building, floor, specific_location,
+                               date_reported, image_hash, resolved)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, (row["item_type"], image_path, row["tags"], row["location"], row["area"], row["building"],
+              row["floor"], row["specific_location"], row["date_reported"], row["image_hash"], row.get("resolved", 0)))
+        item_id = cursor.lastrowid
+        cursor.execute("INSERT OR REPLACE INTO import_ids (old_id, new_id) VALUES (?, ?)", (row["id"], item_id))
+        tags = json.loads(row["item_tags"] or "[]")
+        cursor.executemany("INSERT OR IGNORE INTO item_tags (item_id, tag, confidence) VALUES (?, ?, ?)",
+                           [(item_id, tag, confidence) for tag, confidence in tags])
+        if row.get("embedding"):
+            cursor.execute("INSERT OR REPLACE INTO item_embeddings (item_id, model, vector) VALUES (?, ?, ?)",
+                           (item_id, row["embedding_model"], base64.b64decode(row["embedding"])))
+        if archived:
+            archived_ids.append((row.get("date_archived"), item_id))
+        inserted += 1
+    if archived_ids:
+        retention.archive_batch(conn, [item_id for _, item_id in archived_ids])
+        cursor.executemany("UPDATE items_archive SET date_archived=COALESCE(?, date_archived) WHERE id=?",
+                           archived_ids)
+    return inserted, skipped
+
+
+def import_matches(conn, rows):
+    before = conn.total_changes
+    conn.executemany("""
+        INSERT INTO matches (lost_id, found_id, score, date_matched)
+        SELECT lost.new_id, found.new_id, ?, ?
+        FROM import_ids AS lost, import_ids AS found
+        WHERE lost.old_id=? AND found.old_id=?
+        ON CONFLICT (lost_id, found_id) DO NOTHING
+    """, [(row["score"], row["date_matched"], row["lost_id"], row["found_id"]) for row in rows])
+    return conn.total_changes - before
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export or import items together with their images.")
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument("--export", metavar="ARCHIVE", help="write every item to a .tar or .tar.gz archive")
+    group.add_argument("--import", dest="import_path", metavar="ARCHIVE", help="add the items of an archive")
+    parser.add_argument("--format", choices=["jsonl", "parquet"], default="jsonl",
+                        help="row format inside the archive, parquet needs pyarrow")
+    parser.add_argument("--store-directory", default=image_store.STORE_DIRECTORY,
+                        help="where imported images are stored")
+    parser.add_argument("--cold-directory", default=config.COLD_STORAGE_DIRECTORY,
+                        help="where imported images of archived reports are stored")
+    args = parser.parse_args(sys.argv[1:])
+    if args.export:
+        export_archive(args.export, args.format)
+    else:
+        import_archive(args.import_path, args.store_directory, args.cold_directory)
@@ -0,0 +1,293 @@
+import argparse
+import math
+import os
+import sys
+import tempfile
+import time
+
+import database
+import duplicates
+import image_store
+import matching
+from image_detection import CONFIDENCE_THRESHOLD, extract_boxes, get_detector, iou
+
+VIDEO_EXTENSIONS = (".mp4", ".avi", ".mov", ".mkv", ".m4v")
+# Frames per second of video looked at while something is happening
+SAMPLE_FPS = 2.0
+# While the scene is static and no tracked item moves the sampling interval doubles up to this factor
+MAX_SKIP_FACTOR = 8
+# Mean absolute difference of a 64x36 greyscale frame, below this the scene counts as static
+MOTION_THRESHOLD = 2.0
+TRACK_IOU = 0.3
+# A track whose box overlaps its previous box by at least this much counts as standing still
+TRACK_STILL_IOU = 0.9
+# A track ends after this many sampled frames without a matching detection
+TRACK_MAX_AGE = 4
+# Tracks seen in fewer sampled frames are treated as false positives
+TRACK_MIN_HITS = 2
+CROP_PADDING = 0.1
+
+
+class Track:
+    def __init__(self, track_id, label, box, frame_index):
+        self.track_id = track_id
+        self.label = label
+        self.box = box
+        self.first_frame = frame_index
+        self.last_seen = 0
+        self.hits = 0
+        self.confidence = 0.0
+        self.best_score = -1.0
+        self.best_crop = None
+        self.best_frame = frame_index
+
+
+class IoUTracker:
+    # Greedy IoU association per label, good enough for a fixed camera over a desk
+    def __init__(self, min_iou=TRACK_IOU, max_age=TRACK_MAX_AGE):
+        self.min_iou = min_iou
+        self.max_age = max_age
+        self.tracks = []
+        self.next_id = 1
+        self.step = 0
+        # Whether a track started or moved in the last update, an item lying still on the desk
+        # does not keep the sampling rate up
+        self.moving = False
+
+    def update(self, frame_index, frame, boxes):
+        # Returns the tracks that ended with this frame
+        self.step += 1
+        self.moving = False
+        pairs = sorted(((iou(track.box, box), track_index, box_index)
+                        for track_index, track in enumerate(self.tracks)
+                        for box_index, (label, _, box) in enumerate(boxes) if label == track.label),
+                       reverse=True)
+        matched_tracks = set()
+        matched_boxes = set()
+        for overlap, track_index, box_index in pairs:
+            if overlap < self.min_iou:
+                break
+            if track_index in matched_tracks or box_index in matched_boxes:
+                continue
+            matched_tracks.add(track_index)
+            matched_boxes.add(box_index)
+            if overlap < TRACK_STILL_IOU:
+                self.moving = True
+            self.observe(self.tracks[track_index], frame_index, frame, boxes[box_index])
+
+        for box_index, detection in enumerate(boxes):
+            if box_index not in matched_boxes:
+                track = Track(self.next_id, detection[0], detection[2], frame_index)
+                self.next_id += 1
+                self.moving = True
+                self.observe(track, frame_index, frame, detection)
+                self.tracks.append(track)
+
+        ended = [track for track in self.tracks if self.step - track.last_seen > self.max_age]
+        self.tracks = [track for track in self.tracks if self.step - track.last_seen <= self.max_age]
+        return ended
+
+    def observe(self, track, frame_index, frame, detection):
+        _, confidence, box = detection
+        track.box = box
+        track.last_seen = self.step
+        track.hits += 1
+        track.confidence = max(track.confidence, confidence)
+        crop = crop_box(frame, box)
+        score = crop_score(crop, confidence)
+        if score > track.best_score:
+            # Only the best crop so far is kept, never every frame of the track
+            track.best_score = score
+            track.best_crop = crop.copy()
+            track.best_frame = frame_index
+
+    def finish(self):
+        ended, self.tracks = self.tracks, []
+        return ended
+
+
+def crop_box(frame, box):
+    height, width = frame.shape[:2]
+    pad_x = (box[2] - box[0]) * CROP_PADDING
+    pad_y = (box[3] - box[1]) * CROP_PADDING
+    x1, y1 = max(0, int(box[0] - pad_x)), max(0, int(box[1] - pad_y))
+    x2, y2 = min(width, int(box[2] + pad_x)), min(height, int(box[3] + pad_y))
+    return frame[y1:y2, x1:x2]
+
+
+def crop_score(crop, confidence):
+    # Confident, large and sharp crops make the best item photos
+    import cv2
+
+    if crop.size == 0:
+        return 0.0
+    sharpness = cv2.Laplacian(cv2.cvtColor(crop, cv2.COLOR_BGR2GRAY), cv2.CV_64F).var()
+    return confidence * math.sqrt(crop.shape[0] * crop.shape[1]) * math.log1p(sharpness)
+
+
+def sample_frames(path, sample_fps=SAMPLE_FPS, max_skip_factor=MAX_SKIP_FACTOR, is_busy=lambda: True):
+    # Skipped frames are only grabbed, which saves the colour conversion and copy of read(). With
+    # inter-frame codecs grab() still has to decode them, only a longer interval saves that work.
+    # The interval grows while the frames and the tracked items stay still, and drops back as soon
+    # as something moves
+    import cv2
+
+    capture = cv2.VideoCapture(path)
+    if not capture.isOpened():
+        raise OSError(f"Could not open video {path}")
+    fps = capture.get(cv2.CAP_PROP_FPS) or 25.0
+    base_interval = max(1, round(fps / sample_fps))
+    interval = base_interval
+    previous = None
+    frame_index = -1
+    try:
+        while True:
+            for _ in range(interval - 1):
+                if not capture.grab():
+                    return
+                frame_index += 1
+            ok, frame = capture.read()
+            if not ok:
+                return
+            frame_index += 1
+
+            small = cv2.cvtColor(cv2.resize(frame, (64, 36), interpolation=cv2.INTER_AREA), cv2.COLOR_BGR2GRAY)
+            moving = previous is None or cv2.absdiff(small, previous).mean() >= MOTION_THRESHOLD
+            previous = small
+            if moving or is_busy():
+                interval = base_interval
+            else:
+                interval = min(interval * 2, base_interval * max_skip_factor)
+            yield frame_index, frame_index / fps, frame
+    finally:
+        capture.release()
+
+
+def save_tracks(conn, detector, tracks, video_path, args, location, store_directory):
+    import cv2
+    import embeddings
+
+    tracks = [track for track in tracks if track.hits >= args.min_hits and track.best_crop is not None]
+    keys = [f"{video_path}#track={track.track_id}&frame={track.best_frame}" for track in tracks]
+    done = {row[0] for row in conn.execute(
+        f"SELECT source_path FROM ingested_files WHERE source_path IN ({','.join('?' * len(keys))})", keys)} \
+        if keys else set()
+    tracks = [(track, key) for track, key in zip(tracks, keys) if key not in done]
+    if not tracks:
+        return 0
+
+    cursor = conn.cursor()
+    item_ids = []
+    for track, key in tracks:
+        # The crop goes through the image store like any uploaded photo
+        handle, temp_path = tempfile.mkstemp(suffix=".jpg")
+        os.close(handle)
+        try:
+            cv2.imwrite(temp_path, track.best_crop)
+            image_hash = duplicates.to_signed(duplicates.image_hash(temp_path))
+            save_path, _ = image_store.store_image(temp_path, store_directory)
+        finally:
+            os.remove(temp_path)
+        item_id = database.insert_item(cursor, args.item_type, save_path, [(track.label, track.confidence)],
+                                       location, args.area, args.building, args.floor, args.specific_location,
+                                       image_hash)
+        item_ids.append(item_id)
+        print(f"Track {track.track_id}: {track.label} seen in {track.hits} frames, saved as item {item_id}")
+
+    cursor.executemany("INSERT INTO ingested_files (source_path, item_id) VALUES (?, ?)",
+                       [(key, item_id) for (_, key), item_id in zip(tracks, item_ids)])
+    if detector.can_embed():
+        vectors = detector.embed([track.best_crop for track, _ in tracks])
+        embeddings.save_embeddings(cursor, zip(item_ids, vectors), detector.embedding_name)
+    for item_id in item_ids:
+        matching.score_item(conn, item_id)
+    conn.commit()
+    return len(item_ids)
+
+
+def ingest_video(conn, detector, video_path, args, location, store_directory):
+    tracker = IoUTracker(args.track_iou, args.track_max_age)
+    frames = sample_frames(video_path, args.sample_fps, args.max_skip_factor, is_busy=lambda: tracker.moving)
+    start = time.perf_counter()
+    sampled = 0
+    saved = 0
+    video_time = 0.0
+    batch = []
+
+    def flush():
+        # One forward pass for the whole batch of sampled frames
+        ended = []
+        results = detector.predict([frame for _, _, frame in batch])
+        for (frame_index, _, frame), result in zip(batch, results):
+            ended += tracker.update(frame_index, frame, extract_boxes(result, args.confidence))
+        batch.clear()
+        return save_tracks(conn, detector, ended, video_path, args, location, store_directory)
+
+    for frame_index, timestamp, frame in frames:
+        batch.append((frame_index, timestamp, frame))
+        sampled += 1
+        video_time = timestamp
+        if len(batch) >= args.batch_size:
+            saved += flush()
+    if batch:
+        saved += flush()
+    saved += save_tracks(conn, detector, tracker.finish(), video_path, args, location, store_directory)
+
+    elapsed = time.perf_counter() - start
+    speed = video_time / elapsed if elapsed else 0.0
+    print(f"{video_path}: {video_time:.0f}s of video, {sampled} frames sampled, {saved} items saved "
+          f"in {elapsed:.1f}s ({speed:.1f}x real time)")
+    return saved
+
+
+def collect_video_paths(patterns):
+    paths = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            for root, _, files in os.walk(pattern):
+                paths += [os.path.join(root, name) for name in sorted(files) if name.lower().endswith(VIDEO_EXTENSIONS)]
+        else:
+            paths.append(pattern)
+    return paths
+
+
+def video_ingest(args):
+    store_directory = os.path.join(args.save_directory, "objects")
+    location = database.format_location(args.area, args.building, args.floor, args.specific_location)
+    detector = get_detector()
+    detector.load()
+
+    conn = database.connect()
+    try:
+        database.migrate(conn)
+        for video_path in collect_video_paths(args.paths):
+            try:
+                ingest_video(conn, detector, os.path.abspath(video_path), args, location, store_directory)
+            except OSError as e:
+                print(f"Skipping {video_path}: {e}")
+    finally:
+        conn.close()
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Register every object seen in recorded desk footage as an item.")
+    parser.add_argument("paths", nargs="+", help="video files or directories")
+    parser.add_argument("--type", dest="item_type", choices=["Lost", "Found"], default="Found")
+    parser.add_argument("--area", default="University")
+    parser.add_argument("--building", required=True)
+    parser.add_argument("--floor", default="Not applicable")
+    parser.add_argument("--specific-location", default="Lost and found desk")
+    parser.add_argument("--sample-fps", type=float, default=SAMPLE_FPS, help="frames per second looked at")
+    parser.add_argument("--max-skip-factor", type=int, default=MAX_SKIP_FACTOR,
+                        help="how much sparser static footage may be sampled")
+    parser.add_argument("--batch-size", type=int, default=8, help="sampled frames per model call")
+    parser.add_argument("--confidence", type=float, default=CONFIDENCE_THRESHOLD)
+    parser.add_argument("--track-iou", type=float, default=TRACK_IOU)
+    parser.add_argument("--track-max-age", type=int, default=TRACK_MAX_AGE)
+    parser.add_argument("--min-hits", type=int, default=TRACK_MIN_HITS)
+    parser.add_argument("--save-directory", default="saved_items")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    video_ingest(parse_args(sys.argv[1:]))
@@ -0,0 +1,290 @@
+import sqlite3
+import threading
+
+from PyQt5.QtCore import QObject, QRunnable, QThreadPool, pyqtSignal
+
+import config
+import database
+import duplicates
+import image_store
+import metrics
+from image_detection import get_detector, identify_detections
+from thumbnails import create_missing_thumbnails
+
+_detection_pool = None
+
+
+def detection_pool():
+    global _detection_pool
+    if _detection_pool is None:
+        _detection_pool = QThreadPool()
+        # Inference is serialised by the detector, extra threads would only queue on its lock
+        _detection_pool.setMaxThreadCount(1)
+    return _detection_pool
+
+
+_query_pool = None
+
+
+def query_pool():
+    global _query_pool
+    if _query_pool is None:
+        # Listing and search queries, kept apart from thumbnail work so they never wait behind it
+        _query_pool = QThreadPool()
+        _query_pool.setMaxThreadCount(2)
+    return _query_pool
+
+
+class QuerySignals(QObject):
+    finished = pyqtSignal(object)
+    failed = pyqtSignal(str)
+
+
+class QueryJob(QRunnable):
+    # Runs query(conn, *args) on a pooled connection off the GUI thread
+    def __init__(self, query, *args):
+        super().__init__()
+        self.query = query
+        self.args = args
+        self.cancelled = False
+        self.conn = None
+        self.lock = threading.Lock()
+        self.signals = QuerySignals()
+
+    def cancel(self):
+        # A job that is still queued skips its query, a running one is interrupted so the
+        # connection is free for the next query
+        with self.lock:
+            self.cancelled = True
+            if self.conn:
+                self.conn.interrupt()
+
+    def run(self):
+        conn = None
+        try:
+            with self.lock:
+                if self.cancelled:
+                    return
+                conn = self.conn = database.connect()
+            result = self.query(conn, *self.args)
+        except sqlite3.Error as e:
+            # An interrupted query fails with an OperationalError, that is the cancellation
+            if not self.cancelled:
+                self.signals.failed.emit(str(e))
+            return
+        finally:
+            if conn:
+                # Cleared before the connection goes back to the pool, so a late cancel
+                # never interrupts another job's query
+                with self.lock:
+                    self.conn = None
+                conn.close()
+        if not self.cancelled:
+            self.signals.finished.emit(result)
+
+
+class DetectionSignals(QObject):
+    finished = pyqtSignal(int, list, object)
+    failed = pyqtSignal(int, str)
+    stored = pyqtSignal(int, str, bool)
+    store_failed = pyqtSignal(int, str)
+
+
+class DetectionJob(QRunnable):
+    # Detects, hashes and stores the picked image, so submitting only has to write the row
+    def __init__(self, job_id, image_path, store_directory):
+        super().__init__()
+        self.setAutoDelete(False)
+        self.job_id = job_id
+        self.image_path = image_path
+        self.store_directory = store_directory
+        self.cancelled = False
+        self.signals = DetectionSignals()
+
+    def cancel(self):
+        self.cancelled = True
+        detection_pool().tryTake(self)
+
+    def run(self):
+        if self.cancelled:
+            return
+        try:
+            detections = identify_detections(self.image_path)
+        except Exception as e:
+            if not self.cancelled:
+                self.signals.failed.emit(self.job_id, str(e))
+            detections = None
+
+        if detections is not None:
+            try:
+                with metrics.span("upload.image_hash"):
+                    image_hash = duplicates.image_hash(self.image_path)
+                # Build the duplicate index here rather than on the GUI thread at submit time
+                duplicates.get_tree()
+            except Exception as e:
+                print(f"Could not check for duplicates: {e}")
+                image_hash = None
+            if not self.cancelled:
+                self.signals.finished.emit(self.job_id, detections, image_hash)
+
+        if self.cancelled:
+            return
+        try:
+            # Decoding, downscaling and recompressing a large photo takes too long for the GUI thread
+            with metrics.span("submit.store_image"):
+                save_path, created = image_store.store_image(self.image_path, self.store_directory)
+        except Exception as e:
+            self.signals.store_failed.emit(self.job_id, str(e))
+            return
+        self.signals.stored.emit(self.job_id, save_path, created)
+
+
+class ThumbnailSignals(QObject):
+    finished = pyqtSignal(list, list)
+
+
+class ThumbnailJob(QRunnable):
+    def __init__(self, items, width):
+        super().__init__()
+        self.items = items
+        self.width = width
+        self.signals = ThumbnailSignals()
+
+    def run(self):
+        created, failed = create_missing_thumbnails(self.items, self.width)
+        self.signals.finished.emit(created, failed)
+
+
+class ThumbnailBackfillJob(QRunnable):
+    def __init__(self, width):
+        super().__init__()
+        self.width = width
+
+    def run(self):
+        conn = None
+        try:
+            conn = database.connect()
+            cursor = conn.execute("SELECT id, image_path FROM items ORDER BY id DESC")
+            while True:
+                rows = cursor.fetchmany(500)
+                if not rows:
+                    break
+                create_missing_thumbnails(rows, self.width)
+        except sqlite3.Error as e:
+            print(f"Thumbnail backfill failed: {e}")
+        finally:
+            if conn:
+                conn.close()
+
+
+class EmbeddingJob(QRunnable):
+    def __init__(self, item_id, item_type, image_path):
+        super().__init__()
+        self.item_id = item_id
+        self.item_type = item_type
+        self.image_path = image_path
+
+    def run(self):
+        import embeddings
+
+        conn = None
+        try:
+            if config.SERVICE_URL:
+                import service_client
+
+                model, vectors = service_client.embed([self.image_path])
+                vector = vectors[0]
+            else:
+                detector = get_detector()
+                if not detector.can_embed():
+                    return
+                vector = detector.embed([self.image_path])[0]
+                model = detector.embedding_name
+            conn = database.connect()
+            embeddings.save_embedding(conn.cursor(), self.item_id, vector, model)
+            conn.commit()
+            embeddings.add_to_index(self.item_id, self.item_type, vector, model)
+        except Exception as e:
+            print(f"Could not compute embedding for item {self.item_id}: {e}")
+        finally:
+            if conn:
+                conn.close()
+
+
+class SimilaritySignals(QObject):
+    finished = pyqtSignal(int, list)
+    failed = pyqtSignal(int, str)
+
+
+class SimilarityJob(QRunnable):
+    def __init__(self, item_id, item_type, limit):
+        super().__init__()
+        self.item_id = item_id
+        self.item_type = item_type
+        self.limit = limit
+        self.signals = SimilaritySignals()
+
+    def run(self):
+        import embeddings
+
+        try:
+            similar = embeddings.find_similar(self.item_id, self.item_type, self.limit)
+        except Exception as e:
+            self.signals.failed.emit(self.item_id, str(e))
+            return
+        self.signals.finished.emit(self.item_id, [item_id for item_id, _ in similar])
+
+
+class RetentionSignals(QObject):
+    finished = pyqtSignal(int, int)
+    failed = pyqtSignal(str)
+
+
+class RetentionJob(QRunnable):
+    # Archives old and resolved reports in small batches, so the app keeps working meanwhile.
+    # With days=None only reports marked resolved are archived
+    def __init__(self, days=config.RETENTION_DAYS):
+        super().__init__()
+        self.days = days
+        self.signals = RetentionSignals()
+
+    def run(self):
+        import retention
+
+        try:
+            archived, moved = retention.archive_items(self.days)
+        except Exception as e:
+            print(f"Archiving old reports failed: {e}")
+            self.signals.failed.emit(str(e))
+            return
+        if archived:
+            print(f"Archived {archived} reports, {moved} images moved to cold storage")
+        self.signals.finished.emit(archived, moved)
+
+
+class ModelLoadSignals(QObject):
+    ready = pyqtSignal(float)
+    failed = pyqtSignal(str)
+
+
+class ModelLoadJob(QRunnable):
+    def __init__(self):
+        super().__init__()
+        self.setAutoDelete(False)
+        self.signals = ModelLoadSignals()
+
+    def run(self):
+        try:
+            if config.SERVICE_URL:
+                # Detection runs in the shared service, only check that it is up
+                import service_client
+
+                service_client.health()
+                self.signals.ready.emit(0.0)
+                return
+            detector = get_detector()
+            detector.load()
+        except Exception as e:
+            self.signals.failed.emit(str(e))
+            return
+        self.signals.ready.emit(detector.load_time or 0.0)